@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+""" Startup time benchmark for 'causync.py check'.
+
+    Runs an empty interpreter, the status module (causync_status.py), the fast path
+    ('check --status') and the full check N times each and prints the mean and best wall clock time in milliseconds.
+    Usage: python3 benchmarks/bench_startup.py [N]
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+causync = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'causync.py')
+causync_status = os.path.join(os.path.dirname(causync), 'causync_status.py')
+
+
+def bench(cmd, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=os.path.dirname(causync))
+        times.append((time.perf_counter() - start) * 1000)
+    return sum(times) / len(times), min(times)
+
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pidfile = os.path.join(tmp, 'causync.pid')
+        logfile = os.path.join(tmp, 'causync.log')
+        status = ['check', '--status', '-p', pidfile, tmp, tmp]
+        cases = [
+            ("python -c pass", [sys.executable, '-c', 'pass']),
+            ("causync_status", [sys.executable, causync_status, '-p', pidfile]),
+            ("check --status", [sys.executable, causync] + status),
+            ("check", [sys.executable, causync, 'check', '-q', '-p', pidfile, '--logfile', logfile, tmp, tmp]),
+        ]
+
+        for (name, cmd) in cases:
+            (mean, best) = bench(cmd, runs)
+            print("{:<16} mean {:7.1f} ms   best {:7.1f} ms".format(name, mean, best))
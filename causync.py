@@ -2,23 +2,217 @@
 # -*- coding: utf-8 -*-
 """ Rsync wrapper for CausalityGroup """
 
-import logging
+# only cheap modules are imported here, the rest (logging, subprocess, json, ...)
+#   is imported where it's used, so 'check --status' can answer quickly
 import os
-from shutil import rmtree
+import threading
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+from types import MappingProxyType
+from stat import S_IMODE, S_ISDIR, S_ISLNK, S_ISREG
 import sys
-from argparse import ArgumentParser
-import subprocess
 from datetime import datetime, timedelta
-import signal
 
 import config as conf
+from causync_status import check_status, get_pidfile_arg, get_statusfile
+
+# tasks which only take a destination (or root) argument
+NO_SOURCE_TASKS = ['cleanup-all', 'report', 'pack', 'restore', 'send', 'receive']
+# tasks which take exactly one source argument
+SINGLE_SOURCE_TASKS = ['diff']
+
+# directory listings aren't cached if the directory changed this recently (nanoseconds),
+#   a change in the same timestamp tick (seconds on some filesystems) wouldn't change its mtime
+LISTING_RACY_NS = 2 * 10 ** 9
+# file name suffix of packed backups, see CauSync.pack_snapshot()
+PACK_SUFFIX = ".pack"
+# the status file is updated at most once per this many seconds while rsync reports progress
+PROGRESS_INTERVAL = 1.0
+# rsync --info=progress2 line: bytes, percent, rate, time, and (xfr#N, to-chk=left/total) if a file was done
+PROGRESS_RE = r'^\s*([\d.,]+[KMGTP]?)\s+(\d+)%\s+\S+\s+\d+:\d+:\d+(?:\s+\(xfr#\d+, (ir|to)-chk=(\d+)/(\d+)\))?\s*$'
+# first line of a replication stream, see CauSync.run_send()
+STREAM_MAGIC = b"CAUSYNC-STREAM 1\n"
+
+# widths of the date format directives parse_dirname() can parse without strptime
+DATE_DIRECTIVE_WIDTHS = {'Y': 4, 'm': 2, 'd': 2, 'H': 2, 'M': 2, 'S': 2}
+# date format -> compiled parser (or None if the format needs strptime)
+date_parsers = dict()
+
+
+def compile_date_format(fmt):
+    """ Compiles a date format into (name length, directive slices, literal characters).
+        Returns None if the format contains anything but fixed width numeric directives
+        (see DATE_DIRECTIVE_WIDTHS) and literal characters.
+    """
+
+    (fields, literals) = (list(), list())
+    (pos, i) = (0, 0)
+
+    while i < len(fmt):
+        if fmt[i] != '%':
+            literals.append((pos, fmt[i]))
+            (pos, i) = (pos + 1, i + 1)
+        elif fmt[i + 1:i + 2] == '%':
+            literals.append((pos, '%'))
+            (pos, i) = (pos + 1, i + 2)
+        elif fmt[i + 1:i + 2] in DATE_DIRECTIVE_WIDTHS:
+            width = DATE_DIRECTIVE_WIDTHS[fmt[i + 1]]
+            fields.append((pos, pos + width, fmt[i + 1]))
+            (pos, i) = (pos + width, i + 2)
+        else:
+            return None
+
+    return pos, fields, literals
+
+
+def parse_dirname(name, fmt):
+    """ Returns the date of a backup directory name, or None if it doesn't match fmt.
+        Simple numeric formats (like the default '%Y%m%d') are parsed with string slicing,
+        everything else falls back to datetime.strptime().
+    """
+
+    if fmt not in date_parsers:
+        date_parsers[fmt] = compile_date_format(fmt)
+    parser = date_parsers[fmt]
+
+    if parser and len(name) == parser[0] and all(name[p] == c for (p, c) in parser[2]):
+        values = {'Y': 1900, 'm': 1, 'd': 1, 'H': 0, 'M': 0, 'S': 0}
+        for (start, end, directive) in parser[1]:
+            part = name[start:end]
+            if not (part.isascii() and part.isdigit()):
+                break
+            values[directive] = int(part)
+        else:
+            try:
+                return datetime(values['Y'], values['m'], values['d'], values['H'], values['M'], values['S'])
+            except ValueError:
+                return None
+
+    try:
+        return datetime.strptime(name, fmt)
+    except ValueError:
+        return None
+
+
+def date_key(date):
+    """ Returns the sortable integer key of a date (seconds since 0001-01-01). """
+    return date.toordinal() * 86400 + date.hour * 3600 + date.minute * 60 + date.second
+
+
+class BackupIndex(object):
+    """ Sorted index of the backup directories of a destination.
+        Names are parsed once, dates are stored as a sorted array of integer keys (see date_key()),
+        queries are bisect lookups.
+
+        Args:
+            dirnames (list): directory listing of the destination, datetime entries are taken as they are
+            date_format (str): backup directory name format (config.DATE_FORMAT)
+
+        Attributes:
+            keys (array): sorted date keys
+            names (list): backup directory names, in the same order as keys
+            skipped (int): number of entries which aren't backup directory names
+    """
+
+    def __init__(self, dirnames, date_format):
+        parsed = list()
+        self.skipped = 0
+
+        for name in dirnames:
+            if isinstance(name, datetime):
+                (date, name) = (name, name.strftime(date_format))
+            else:
+                date = parse_dirname(name, date_format)
+            if date:
+                parsed.append((date_key(date), name, date))
+            else:
+                self.skipped += 1
+
+        parsed.sort()
+        self.keys = array('q', [p[0] for p in parsed])
+        self.names = [p[1] for p in parsed]
+        self._dates = [p[2] for p in parsed]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def dates(self, start=0, end=None):
+        """ Returns the dates between positions start and end (ascending). """
+        return self._dates[start:end]
+
+    def position(self, date):
+        """ Returns the position of the first backup newer than date. """
+        return bisect_right(self.keys, date_key(date))
+
+    def latest(self, count):
+        """ Returns the names of the latest count backups (descending by date). """
+        return self.names[:-count - 1:-1] if count > 0 else []
+
+    def older_than(self, date):
+        """ Returns the names of the backups which aren't newer than date (ascending). """
+        return self.names[:self.position(date)]
+
+    def in_period(self, start, end):
+        """ Returns the names of the backups newer than start, but not newer than end (ascending). """
+        return self.names[self.position(start):self.position(end)]
+
+
+class CauSyncError(Exception):
+    """ Raised when a job can't continue, the error is already logged. """
+
+
+class Settings(object):
+    """ Immutable settings of one job.
+        They're copied from a config module (or another Settings object), so several jobs
+        with different settings can run in one process. Use replace() to change them.
+
+        Args:
+            config (module|Settings): the uppercase attributes of config are copied
+            overrides: settings to override, for example Settings(config, DATE_FORMAT="%Y%m%d_%H%M")
+    """
+
+    def __init__(self, config=None, **overrides):
+        values = dict((k, getattr(config, k)) for k in dir(config) if k.isupper()) if config else dict()
+        values.update(overrides)
+
+        for (k, v) in values.items():
+            # dicts like BACKUPS_TO_KEEP are copied too, and made read-only
+            if isinstance(v, (dict, MappingProxyType)):
+                v = MappingProxyType(dict(v))
+            object.__setattr__(self, k, v)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("settings are immutable, use replace()")
+
+    def __delattr__(self, name):
+        raise AttributeError("settings are immutable, use replace()")
+
+    def __repr__(self):
+        return "Settings({})".format(", ".join("{}={!r}".format(k, getattr(self, k))
+                                               for k in dir(self) if k.isupper()))
+
+    def replace(self, **overrides):
+        """ Returns a copy of the settings with overrides applied. """
+        return Settings(self, **overrides)
+
+
+# results of the CauSync.sync() and CauSync.cleanup() library calls
+SyncResult = namedtuple('SyncResult', ['snapshot', 'duration', 'stats', 'output', 'cleanup'])
+CleanupResult = namedtuple('CleanupResult', ['destination', 'kept', 'deleted', 'duration'])
+
+# destination directory -> lock, so one process doesn't run two jobs on the same destination
+destination_locks = dict()
+destination_locks_lock = threading.Lock()
 
 
 class CauSync(object):
     """ CauSync object for sync-related functions.
+        One object is one job, jobs don't share state, so they can run in parallel threads.
+        The CLI calls run(), library users call sync() and cleanup().
 
         Args:
-            config (module): config module is passed to CauSync here
+            config (module|Settings): config module or Settings object, it's copied into a Settings object
             src (str): backup source directory, this is backed up to the destination
             dst (str): backup destination directory, this is where source is backed up to
             task (str): contains the task to execute
@@ -31,6 +225,19 @@ class CauSync(object):
             loglevel (str): logging level (see config or help(logging)
             verbose (bool): increase verbosity by one step
             pidfile (str): file containing the process ID
+            cleanup (bool): run cleanup after sync (stored as cleanup_after_sync)
+            logfile (str): log file path
+            plan (bool): print a JSON cleanup plan to stdout instead of deleting anything
+            apply (str): JSON cleanup plan file, cleanup deletes exactly what it lists
+            shards (bool): sync each top-level directory of the sources with a separate rsync call
+            shard_file (str): file listing groups of top-level directories to sync together
+            overlap_cleanup (bool): start deleting expired backups while the sync runs, implies cleanup
+            snapshot (str): restore, send: backup directory name to restore from or to send
+            member (str): restore: path of the file to restore, relative to the backup directory
+            output (str): restore, send: file to restore to or to write the stream to (default: stdout)
+            progress (bool): sync: estimate the size of the sources and write progress and ETA to the status file
+            estimate (bool): check: print the JSON size estimate of the sources and exit
+            base (str): send: backup directory name the receiver already has, unchanged files are sent as links to it
 
         Attributes:
             pid (int): PID of the current process
@@ -40,300 +247,2425 @@ class CauSync(object):
             logger (object): the logger object used for logging to file/console
     """
 
-    curdate = None
+    curdate = None
+
+    def __init__(self, config, src, dst, task, no_incremental=False, quiet=False,
+                 dry_run=False, selfname="causync.py", excludes=None, exclude_from=False,
+                 loglevel=None, verbose=False, pidfile=None, cleanup=False, logfile=None,
+                 plan=False, apply=None, shards=False, shard_file=None, overlap_cleanup=False,
+                 snapshot=None, member=None, output=None, progress=False, estimate=False, base=None):
+
+        overrides = dict()
+        if pidfile:
+            overrides['PIDFILE'] = pidfile
+        if logfile:
+            overrides['LOGFILE'] = logfile
+
+        self.config = Settings(config, **overrides)
+        self.name = selfname
+        self.pid = os.getpid()
+        # status file fields, it's only written while we own the pidfile
+        self.phase = None
+        self.bytes_done = 0
+        self.write_status = False
+
+        self.no_incremental = no_incremental
+        self.excludes = excludes if excludes else []
+        if exclude_from:
+            self.excludes = self.excludes + CauSync.parse_exclude_file(exclude_from)
+
+        self.src = src
+        self.src_abs = self.parse_src(self.src)
+        if self.src_abs is False or (not self.src_abs and task not in NO_SOURCE_TASKS):
+            raise CauSyncError("source directory error: {}".format(src))
+
+        self.dst = dst
+        self.dst_abs = os.path.realpath(dst)
+
+        self.task = task
+        self.quiet = quiet
+        self.dry_run = dry_run
+        self.overlap_cleanup = overlap_cleanup or (cleanup and self.config.CLEANUP_OVERLAP)
+        self.cleanup_after_sync = cleanup or self.overlap_cleanup
+        self.plan = plan
+        self.apply = apply
+        self.shards = shards or bool(shard_file) or self.config.SYNC_SHARDS
+        self.shard_file = shard_file
+        self.snapshot = snapshot
+        self.member = member
+        self.output = output
+        self.base = base
+        self.progress = progress or self.config.SYNC_PROGRESS
+        self.show_estimate = estimate
+        # see estimate_sources() and update_progress(), the status file contains progress_status
+        self.estimate = None
+        self.progress_status = dict()
+        self.sync_started = None
+        # see get_backend()
+        self.backend = None
+
+        self.curdate = datetime.now()
+        # (dirnames, date format, BackupIndex) of the last get_index() call
+        self.index_cache = None
+        # directory -> (mtime, backup names), and the packed backups and skipped entries, see list_backups()
+        self.listing_cache = dict()
+        self.listing_packed = dict()
+        self.listing_skipped = dict()
+        self.logger = self.get_logger(loglevel, verbose, self.config.LOGFILE)
+
+    def parse_src(self, src):
+        """ Parses source directory arguments into a list. """
+        if isinstance(src, list):
+            return [os.path.realpath(i) for i in src]
+        elif type(src) == str:
+            return [os.path.realpath(src)]
+        else:
+            return False
+
+    def run(self):
+        """ Main run function of the CLI. """
+
+        import json
+        import signal
+
+        signal.signal(signal.SIGINT, self.signal_handler)
+        signal.signal(signal.SIGTERM, self.signal_handler)
+
+        pidfile_exists = os.path.isfile(self.config.PIDFILE)
+        # pgrep forks, don't call it if the pidfile already answers the question
+        is_running = self.is_running() if self.config.CHECK_PGREP and not pidfile_exists else False
+
+        self.logger.info("started with PID {}".format(self.pid))
+        self.logger.info("Excludes: {}".format(self.excludes))
+
+        if len(self.src_abs) > 1:
+            self.logger.info("syncing multiple source directories")
+
+        if self.dry_run:
+            self.logger.info("doing dry run")
+
+        if self.task == 'check' and self.show_estimate:
+            # schedulers ask before starting the sync, it doesn't need the pidfile
+            json.dump(self.estimate_sync(), sys.stdout)
+            sys.stdout.write("\n")
+            return
+
+        if self.task == 'cleanup':
+            if self.plan:
+                # planning is read-only, it doesn't need the pidfile
+                json.dump(self.plan_cleanup(), sys.stdout, indent=2)
+                sys.stdout.write("\n")
+                return
+
+            try:
+                self.create_pidfile()
+                self.cleanup(self.load_cleanup_plan(self.apply) if self.apply else None, self.curdate)
+            finally:
+                self.remove_pidfile()
+
+        elif self.task == 'cleanup-all':
+            if self.plan:
+                json.dump(self.plan_cleanup_all(), sys.stdout, indent=2)
+                sys.stdout.write("\n")
+                return
+
+            try:
+                self.create_pidfile()
+                self.run_cleanup_all()
+            finally:
+                self.remove_pidfile()
+
+        elif self.task == 'verify':
+            self.run_verify()
+
+        elif self.task == 'diff':
+            self.run_diff()
+
+        elif self.task == 'report':
+            self.run_report()
+
+        elif self.task == 'pack':
+            try:
+                self.create_pidfile()
+                self.run_pack()
+            finally:
+                self.remove_pidfile()
+
+        elif self.task == 'restore':
+            self.run_restore(self.snapshot, self.member, self.output)
+
+        elif self.task == 'send':
+            if self.output:
+                with open(self.output, 'wb') as out:
+                    self.run_send(self.snapshot, self.base, out)
+            else:
+                self.run_send(self.snapshot, self.base, sys.stdout.buffer)
+                sys.stdout.flush()
+
+        elif self.task == 'receive':
+            try:
+                self.create_pidfile()
+                self.run_receive(sys.stdin.buffer)
+            finally:
+                self.remove_pidfile()
+
+        elif self.task in ['check', 'sync', 'rebase']:
+
+            if pidfile_exists or is_running:
+                self.logger.info(
+                    "causync is already running on {} or the default pidfile exists".format(", ".join(self.src_abs)))
+            else:
+                self.logger.info("causync is not running yet on {}".format(", ".join(self.src_abs)))
+                if self.task == 'check' and os.path.isdir(self.dst_abs):
+                    index = self.get_index(self.list_backups())
+                    self.logger.info("{} backups in {}, latest: {}, skipped {} other entries".format(
+                        len(index), self.dst_abs, index.names[-1] if index.names else None, self.count_skipped()))
+                if self.task == 'sync':
+                    try:
+                        self.create_pidfile()
+                        self.sync(self.curdate)
+                    finally:
+                        self.remove_pidfile()
+                elif self.task == 'rebase':
+                    try:
+                        self.create_pidfile()
+                        self.run_rebase()
+                    finally:
+                        self.remove_pidfile()
+
+    def lock_destination(self):
+        """ Returns the lock of the destination directory, acquired.
+            Raises CauSyncError if another job of this process is using the destination.
+        """
+
+        with destination_locks_lock:
+            lock = destination_locks.setdefault(self.dst_abs, threading.RLock())
+
+        if not lock.acquire(blocking=False):
+            self.logger.error("another job is already running on {}".format(self.dst_abs))
+            raise CauSyncError("destination is busy: {}".format(self.dst_abs))
+
+        return lock
+
+    def sync(self, curdate=None):
+        """ Library API: syncs the sources into a new backup, deduplicates it (if config.DEDUP_POOL is set)
+            and cleans up (if cleanup_after_sync is set). The run is saved in the run history.
+            curdate (the backup's date) defaults to now. Returns a SyncResult.
+        """
+
+        lock = self.lock_destination()
+
+        try:
+            self.curdate = curdate if curdate else datetime.now()
+            started = datetime.now()
+            # counted before the sync, so run_sync() reuses the cached listing
+            skipped = self.count_skipped() if os.path.isdir(self.dst_abs) else 0
+            if self.progress:
+                self.set_status('scan')
+                self.estimate = self.estimate_sources()
+            overlap = self.start_overlapped_cleanup() if self.overlap_cleanup else None
+            try:
+                output = self.run_sync()
+            finally:
+                overlap_deleted = self.stop_overlapped_cleanup(overlap) if overlap else []
+            stats = CauSync.parse_rsync_stats(output)
+            if self.progress and 'Number of files' in stats:
+                # the next estimate is this sync's file count and size
+                self.save_scan_cache(stats['Number of files'], stats.get('Total file size', 0))
+            record = {'date': started.isoformat(), 'task': 'sync',
+                      'duration': (datetime.now() - started).total_seconds(),
+                      'bytes_transferred': stats.get('Total transferred file size'),
+                      'files_scanned': stats.get('Number of files'),
+                      'file_list_generation_time': stats.get('File list generation time'),
+                      'entries_skipped': skipped}
+
+            if self.config.DEDUP_POOL and not self.dry_run:
+                self.run_dedup()
+
+            cleanup = None
+            if self.cleanup_after_sync:
+                cleanup = self.cleanup(curdate=self.curdate, save_history=False)
+                # add the backups deleted while syncing, the duration only counts the part after the sync
+                cleanup = cleanup._replace(deleted=sorted(set(cleanup.deleted) | set(overlap_deleted)))
+                record['cleanup_duration'] = cleanup.duration
+
+            self.save_history(record)
+
+            snapshot = os.path.join(self.dst_abs, self.curdate.strftime(self.config.DATE_FORMAT))
+            return SyncResult(snapshot, record['duration'], stats, output, cleanup)
+        finally:
+            lock.release()
+            self.close()
+
+    def cleanup(self, plan=None, curdate=None, save_history=True):
+        """ Library API: deletes old backups, or exactly what plan (see plan_cleanup()) lists.
+            curdate (the date retention is counted from) defaults to now. Returns a CleanupResult.
+        """
+
+        lock = self.lock_destination()
+
+        try:
+            self.curdate = curdate if curdate else datetime.now()
+            started = datetime.now()
+            plan = plan if plan else self.plan_cleanup(estimate=False)
+            skipped = self.count_skipped(plan['destination']) if os.path.isdir(plan['destination']) else 0
+            deleted = self.apply_cleanup_plan(plan)
+            duration = (datetime.now() - started).total_seconds()
+
+            if save_history:
+                self.save_history({'date': started.isoformat(), 'task': 'cleanup', 'cleanup_duration': duration,
+                                   'entries_skipped': skipped})
+
+            return CleanupResult(plan['destination'], [i['name'] for i in plan.get('keep', [])],
+                                 deleted, duration)
+        finally:
+            lock.release()
+            self.close()
+
+    def start_overlapped_cleanup(self):
+        """ Starts deleting expired backups in a background thread, so space is freed while rsync runs.
+            The backups rsync reads (the --link-dest bases and the copy-on-write source) are left
+            for the cleanup after the sync. Returns the (thread, stop event, deleted backup names)
+            for stop_overlapped_cleanup(), or None if there is nothing to delete.
+        """
+
+        if not os.path.isdir(self.dst_abs):
+            return None
+
+        plan = self.plan_cleanup(estimate=False)
+        # the latest backup is the copy-on-write source, and it's always among the --link-dest bases
+        in_use = set(os.path.basename(i) for i in self.find_latest_backups(
+            self.list_backups(), self.config.BACKUPS_LINK_DEST_COUNT))
+        dirnames = [i for i in self.get_plan_dirnames(plan) if i not in in_use]
+        if not dirnames:
+            return None
+
+        self.logger.info("deleting {} expired backups while syncing".format(len(dirnames)))
+        (stop, deleted) = (threading.Event(), list())
+        thread = threading.Thread(target=self.run_overlapped_cleanup, args=(dirnames, stop, deleted),
+                                  name="causync-cleanup", daemon=True)
+        thread.start()
+
+        return (thread, stop, deleted)
+
+    def stop_overlapped_cleanup(self, overlap):
+        """ Stops the thread started by start_overlapped_cleanup() after its current deletion.
+            Returns the names of the deleted backups.
+        """
+
+        (thread, stop, deleted) = overlap
+        stop.set()
+        thread.join()
+
+        self.logger.info("deleted {} expired backups while syncing".format(len(deleted)))
+        return sorted(deleted)
+
+    def run_overlapped_cleanup(self, dirnames, stop, deleted):
+        """ Deletes the backup directories (oldest first) until stop is set.
+            Runs with the lowest CPU priority (the I/O priority follows it unless it's set explicitly),
+            and waits get_cleanup_delay() seconds before each deletion.
+        """
+
+        if sys.platform.startswith('linux'):
+            # on Linux the nice value of a thread can be set on its own
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+            except OSError as e:
+                self.logger.debug("can't lower the priority of the cleanup thread: {}".format(e))
+
+        try:
+            for dirname in sorted(dirnames):
+                if stop.wait(self.get_cleanup_delay()):
+                    break
+                self.rmtree([dirname])
+                deleted.append(dirname)
+        except Exception as e:
+            self.logger.error("overlapped cleanup failed, leaving the rest for the cleanup after sync: {}".format(e))
+
+    def get_cleanup_delay(self, dst=None):
+        """ Returns how many seconds the overlapped cleanup waits before the next deletion.
+            It's config.CLEANUP_OVERLAP_DELAY with plenty of free space, less as the free space drops
+            and 0 (delete as fast as possible) below config.CLEANUP_MIN_FREE.
+        """
+
+        st = os.statvfs(dst if dst else self.dst_abs)
+        free = st.f_bavail / st.f_blocks if st.f_blocks else 1.0
+        min_free = self.config.CLEANUP_MIN_FREE
+
+        if free <= min_free:
+            return 0
+        if min_free <= 0:
+            return self.config.CLEANUP_OVERLAP_DELAY
+
+        # full delay from twice the minimum free space
+        return self.config.CLEANUP_OVERLAP_DELAY * min(1.0, (free - min_free) / min_free)
+
+    def signal_handler(self, signum, frame):
+        self.logger.info("received SIGINT ({}, {}), removing PIDFILE".format(signum, frame))
+        self.remove_pidfile()
+
+    def create_pidfile(self):
+        self.logger.debug("creating pidfile {}".format(self.config.PIDFILE))
+        try:
+            with open(self.config.PIDFILE, 'w') as f:
+                f.write(str(self.pid))
+        except IOError as e:
+            self.logger.error(e)
+            raise CauSyncError(e)
+
+        self.write_status = True
+        self.set_status('started')
+
+    def remove_pidfile(self):
+        self.logger.debug("removing pidfile {}".format(self.config.PIDFILE))
+        self.write_status = False
+        try:
+            os.remove(get_statusfile(self.config.PIDFILE))
+        except FileNotFoundError:
+            pass
+        try:
+            os.remove(self.config.PIDFILE)
+        except IOError as e:
+            self.logger.error(e)
+            raise CauSyncError(e)
+
+    def set_status(self, phase=None, bytes_done=None):
+        """ Updates the status file (one JSON line next to the pidfile), 'check --status' prints it. """
+
+        import json
+
+        if phase is not None:
+            self.phase = phase
+        if bytes_done is not None:
+            self.bytes_done = bytes_done
+        if not self.write_status:
+            return
+
+        status = {'running': True, 'pid': self.pid, 'task': self.task, 'phase': self.phase,
+                  'bytes_done': self.bytes_done, 'updated': datetime.now().isoformat()}
+        status.update(self.progress_status)
+        statusfile = get_statusfile(self.config.PIDFILE)
+
+        try:
+            with open(statusfile + '.tmp', 'w') as f:
+                f.write(json.dumps(status) + "\n")
+            os.replace(statusfile + '.tmp', statusfile)
+        except IOError as e:
+            self.logger.error(e)
+
+    def run_sync(self):
+        """ This is the backup function.
+            It is executed when the task argument is 'sync'.
+        """
+
+        self.set_status('sync', 0)
+        self.sync_started = datetime.now()
+
+        # self.curdate = datetime.now().strftime(self.config.DATE_FORMAT)
+        extra_flags = ""
+
+        if self.dry_run:
+            extra_flags += " -n "
+
+        if self.progress:
+            extra_flags += " --info=progress2 "
+
+        # sharded syncs add the excludes per rsync call, see run_sharded_sync()
+        if self.excludes and not self.shards:
+            for e in self.excludes:
+                extra_flags += " --exclude={} ".format(e)
+
+        CauSync.makedirs(self.dst_abs)
+
+        incremental_basedirs = []
+        dst = os.path.realpath(os.path.join(self.dst_abs, self.curdate.strftime(self.config.DATE_FORMAT)))
+        backend = self.get_backend()
+        flags = self.get_rsync_flags(dst, backend)
+
+        if backend != 'hardlink':
+            # the backup starts as a copy-on-write clone of the previous one, rsync only updates it
+            extra_flags += " --no-whole-file --delete --delete-excluded "
+            self.create_snapshot(backend, dst)
+
+        elif not self.no_incremental:
+            count = self.config.BACKUPS_LINK_DEST_COUNT
+            # a resumed sync finds today's partial backup, it's no --link-dest base of itself
+            incremental_basedirs = [b for b in self.find_latest_backups(self.list_backups(), count + 1)
+                                    if os.path.realpath(b) != dst][:max(count, 0)]
+            if incremental_basedirs:
+                self.logger.debug("inc_basedirs={}".format(incremental_basedirs))
+                self.logger.info("found incremental basedirs, using them in --link-dest")
+            else:
+                self.logger.info("incremental basedirs not found, skipping --link-dest")
+
+        if self.shards:
+            return self.run_sharded_sync(extra_flags, incremental_basedirs, dst, flags, protect=backend != 'hardlink')
+
+        for basedir in incremental_basedirs:
+            extra_flags += " --link-dest={} ".format(basedir)
+
+        cmd = "rsync {f} {ef} {src} {dst}".format(f=flags,
+                                                  ef=extra_flags,
+                                                  src=" ".join(self.src_abs),
+                                                  dst=dst)
+
+        self.logger.debug("rsync command is: {}".format(cmd))
+        self.logger.info("syncing {} to {}".format(self.src_abs, dst))
+
+        result = self.run_rsync(cmd)
+        self.logger.debug(result)
+        self.set_status(bytes_done=CauSync.parse_rsync_stats(result).get('Total transferred file size', 0))
+
+        self.logger.info("sync finished")
+
+        return result
+
+    def run_rsync(self, cmd):
+        """ Runs an rsync command and returns its output, like subprocess.check_output().
+            With progress, the --info=progress2 lines are parsed while rsync runs (see update_progress())
+            and left out of the output.
+        """
+
+        import re
+        import subprocess
+        import time
+
+        if not self.progress:
+            return subprocess.check_output(cmd, shell=True).decode()
+
+        progress_re = re.compile(PROGRESS_RE)
+        # bytes of the previous rsync calls (shards) of this sync
+        base = self.bytes_done
+        (output, buf, written) = (list(), b'', 0.0)
+
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+        with proc:
+            # progress lines end with '\r', rsync rewrites them in place
+            for chunk in iter(lambda: proc.stdout.read1(65536), b''):
+                lines = re.split(b'[\r\n]', buf + chunk)
+                buf = lines.pop()
+                for line in lines:
+                    line = line.decode(errors='replace')
+                    match = progress_re.match(line)
+                    if not match:
+                        output.append(line)
+                        continue
+                    (size, percent, chk, left, total) = match.groups()
+                    files = int(total) - int(left) if chk == 'to' else None
+                    self.update_progress(base + CauSync.parse_size(size), int(percent), files)
+                    if time.monotonic() - written >= PROGRESS_INTERVAL:
+                        self.set_status()
+                        written = time.monotonic()
+            output.append(buf.decode(errors='replace'))
+
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd, "\n".join(output))
+
+        self.set_status()
+        return "\n".join(output)
+
+    def update_progress(self, bytes_done, percent=None, files_done=None):
+        """ Updates bytes_done and progress_status from rsync's progress.
+            The progress is the larger of the bytes and the files done compared to the estimate
+            (see estimate_sources()), rsync's own percentage is used without an estimate.
+            Unchanged files are only checked, not transferred, so on an incremental sync the file count
+            is the better measure. The ETA assumes the rest of the sync is as fast as the part done.
+        """
+
+        self.bytes_done = bytes_done
+        estimate = self.estimate if self.estimate else dict()
+        ratios = list()
+
+        if estimate.get('bytes'):
+            ratios.append(bytes_done / estimate['bytes'])
+        if files_done is not None and estimate.get('files'):
+            ratios.append(files_done / estimate['files'])
+        if not ratios and percent is not None:
+            ratios.append(percent / 100)
+
+        ratio = min(max(ratios), 1.0) if ratios else None
+        elapsed = (datetime.now() - self.sync_started).total_seconds() if self.sync_started else 0
+        eta = int(elapsed * (1 - ratio) / ratio) if ratio else None
+
+        self.progress_status.update({'files_done': files_done, 'progress': ratio, 'eta': eta,
+                                     'estimated_files': estimate.get('files'),
+                                     'estimated_bytes': estimate.get('bytes')})
+
+    def estimate_sources(self, save=True):
+        """ Returns the estimated size of the sources: a dict with 'files' (counted like rsync's
+            'Number of files'), 'bytes' (size of the regular files), 'date' and 'source' ('cache' or 'scan').
+            The estimate is read from the scan cache (config.SCAN_CACHE_FILE, refreshed by every sync
+            with progress) if it's newer than config.SCAN_CACHE_DAYS days, otherwise the sources are
+            scanned with scan_sources() and the cache is updated if save is True.
+        """
+
+        cached = self.load_scan_cache()
+        if cached and datetime.now() - datetime.strptime(cached['date'][:19], "%Y-%m-%dT%H:%M:%S") \
+                < timedelta(days=self.config.SCAN_CACHE_DAYS):
+            self.logger.debug("estimate from cache: {}".format(cached))
+            return dict(cached, source='cache')
+
+        started = datetime.now()
+        (files, size) = self.scan_sources()
+        self.logger.info("scanned {} files ({} bytes) in {:.2f} seconds".format(
+            files, size, (datetime.now() - started).total_seconds()))
+
+        if not save:
+            return {'files': files, 'bytes': size, 'date': started.isoformat(), 'source': 'scan'}
+
+        estimate = self.save_scan_cache(files, size)
+        return dict(estimate, source='scan')
+
+    def estimate_sync(self):
+        """ Returns estimate_sources() and the expected duration of the sync (seconds),
+            which is the mean duration of the syncs in the last config.REPORT_RECENT_DAYS days (or None).
+            It only reads the scan cache, syncs keep it up to date.
+        """
+
+        since = datetime.now() - timedelta(days=self.config.REPORT_RECENT_DAYS)
+        durations = [r['duration'] for r in self.load_history() if r.get('task') == 'sync' and r.get('duration')
+                     and datetime.strptime(r['date'][:19], "%Y-%m-%dT%H:%M:%S") >= since]
+
+        estimate = self.estimate_sources(save=False)
+        estimate['expected_duration'] = sum(durations) / len(durations) if durations else None
+        return estimate
+
+    def get_scan_key(self):
+        """ Returns the scan cache key of the sources and excludes. """
+        return "\n".join(self.src_abs + ["--exclude={}".format(e) for e in self.excludes])
+
+    def load_scan_cache(self):
+        """ Returns the cached estimate of the sources (see estimate_sources()) or None. """
+
+        import json
+
+        try:
+            with open(os.path.join(self.dst_abs, self.config.SCAN_CACHE_FILE), 'r') as f:
+                return json.load(f).get(self.get_scan_key())
+        except FileNotFoundError:
+            return None
+        except (IOError, ValueError) as e:
+            self.logger.error("can't load scan cache: {}".format(e))
+            return None
+
+    def save_scan_cache(self, files, size):
+        """ Saves the estimate of the sources in the scan cache (if the destination exists) and returns it. """
+
+        import json
+
+        estimate = {'files': files, 'bytes': size, 'date': datetime.now().isoformat()}
+        fname = os.path.join(self.dst_abs, self.config.SCAN_CACHE_FILE)
+        if not os.path.isdir(self.dst_abs) or self.dry_run:
+            return estimate
+
+        try:
+            with open(fname, 'r') as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            cache = dict()
+        cache[self.get_scan_key()] = estimate
+
+        try:
+            with open(fname + '.tmp', 'w') as f:
+                json.dump(cache, f)
+            os.replace(fname + '.tmp', fname)
+        except IOError as e:
+            self.logger.error("can't save scan cache: {}".format(e))
+
+        return estimate
+
+    def scan_sources(self):
+        """ Counts the files and bytes of the sources with os.scandir() in config.SCAN_WORKERS threads.
+            Entries matching the excludes are skipped (see is_excluded()).
+            Returns (files, bytes): files counts every entry like rsync does, including the sources,
+            bytes is the size of the regular files.
+        """
+
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+        # (source, path relative to the source's parent), rsync's excludes are relative to it
+        queue = deque((src, os.path.basename(src)) for src in self.src_abs)
+        (files, size) = (len(self.src_abs), 0)
+        max_pending = self.config.SCAN_WORKERS * 4
+
+        with ThreadPoolExecutor(max_workers=self.config.SCAN_WORKERS) as pool:
+            pending = set()
+            while queue or pending:
+                while queue and len(pending) < max_pending:
+                    pending.add(pool.submit(CauSync.scan_dir, *queue.pop(), self.excludes))
+
+                (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    (dir_files, dir_size, subdirs) = f.result()
+                    files += dir_files
+                    size += dir_size
+                    queue.extend(subdirs)
+
+        return files, size
+
+    @staticmethod
+    def scan_dir(path, rel, excludes):
+        """ Scans one source directory, used by scan_sources().
+            Returns (entries, bytes of regular files, subdirectories to scan next).
+        """
+
+        (files, size, subdirs) = (0, 0, list())
+
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    entry_rel = rel + '/' + entry.name
+                    if excludes and CauSync.is_excluded(entry_rel, entry.name, excludes):
+                        continue
+                    files += 1
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append((entry.path, entry_rel))
+                    elif entry.is_file(follow_symlinks=False):
+                        size += entry.stat(follow_symlinks=False).st_size
+        except (FileNotFoundError, PermissionError):
+            pass
+
+        return files, size, subdirs
+
+    @staticmethod
+    def is_excluded(rel, name, excludes):
+        """ Returns True if an exclude pattern matches a source entry.
+            Patterns without a slash match the name, others the path relative to the source's parent
+            ('/' at the start anchors them, a trailing '/' is ignored). This covers the usual
+            rsync patterns, not every filter rule.
+        """
+
+        from fnmatch import fnmatchcase
+
+        for pattern in excludes:
+            pattern = pattern.rstrip('/')
+            if '/' not in pattern:
+                if fnmatchcase(name, pattern):
+                    return True
+            elif pattern.startswith('/'):
+                if fnmatchcase(rel, pattern[1:]):
+                    return True
+            elif fnmatchcase(rel, pattern) or fnmatchcase(rel, '*/' + pattern):
+                return True
+
+        return False
+
+    def get_backend(self):
+        """ Returns the backup backend of the destination directory: 'btrfs', 'reflink' or 'hardlink'.
+            config.SNAPSHOT_BACKEND selects it, 'auto' uses btrfs subvolume snapshots on btrfs
+            (if the btrfs command exists), reflink copies if the filesystem supports them
+            and hard links (rsync --link-dest) everywhere else.
+            The reflink probe only runs on config.COW_FILESYSTEMS and not on dry runs.
+        """
+
+        import shutil
+        import subprocess
+        import tempfile
+
+        if self.backend:
+            return self.backend
+
+        backend = self.config.SNAPSHOT_BACKEND
+
+        if backend == 'auto':
+            backend = 'hardlink'
+            fstype = CauSync.get_fstype(self.dst_abs)
+            if fstype == 'btrfs' and shutil.which('btrfs'):
+                backend = 'btrfs'
+            elif fstype in self.config.COW_FILESYSTEMS and not self.dry_run:
+                # try to reflink a small file in the destination directory
+                with tempfile.TemporaryDirectory(dir=self.dst_abs) as tmp:
+                    with open(os.path.join(tmp, 'a'), 'w') as f:
+                        f.write('causync')
+                    result = subprocess.run(['cp', '--reflink=always', os.path.join(tmp, 'a'), os.path.join(tmp, 'b')],
+                                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    if result.returncode == 0:
+                        backend = 'reflink'
+
+        self.logger.info("using the {} backend".format(backend))
+        self.backend = backend
+
+        return backend
+
+    def create_snapshot(self, backend, dst):
+        """ Creates the backup directory dst as a copy-on-write clone of the latest backup.
+            With the btrfs backend dst is a subvolume (a snapshot of the latest backup if that's a subvolume too),
+            with the reflink backend it's a reflink copy. Without a previous backup dst is empty.
+        """
+
+        import shlex
+        import subprocess
+
+        if os.path.exists(dst) or self.dry_run:
+            return
+
+        latest = [] if self.no_incremental else self.find_latest_backups(self.list_backups(), 1)
+        base = latest[0] if latest else None
+        (q_base, q_dst) = (shlex.quote(base) if base else None, shlex.quote(dst))
+
+        if backend == 'btrfs' and base and self.is_subvolume(base):
+            cmds = ["btrfs subvolume snapshot {} {}".format(q_base, q_dst)]
+        elif backend == 'btrfs':
+            cmds = ["btrfs subvolume create {}".format(q_dst)]
+            if base:
+                cmds.append("cp -a --reflink=auto {}/. {}".format(q_base, q_dst))
+        elif base:
+            cmds = ["cp -a --reflink=always {} {}".format(q_base, q_dst)]
+        else:
+            cmds = []
+            CauSync.makedirs(dst)
+
+        self.logger.info("creating {} from {}".format(dst, base))
+        for cmd in cmds:
+            self.logger.debug("snapshot command is: {}".format(cmd))
+            subprocess.check_output(cmd, shell=True)
+
+    def is_cow_backup(self, path):
+        """ Returns True if the backup in path may share data by copy-on-write instead of hard links.
+            Unchanged files of such backups have their own inodes, so inode comparisons don't work.
+        """
+
+        backend = self.config.SNAPSHOT_BACKEND
+        if backend == 'auto':
+            return CauSync.get_fstype(path) in self.config.COW_FILESYSTEMS
+        return backend != 'hardlink' or self.is_subvolume(path)
+
+    def is_subvolume(self, path):
+        """ Returns True if path is a btrfs subvolume (their root directory's inode is always 256). """
+        try:
+            return os.lstat(path).st_ino == 256 and CauSync.get_fstype(path) == 'btrfs'
+        except FileNotFoundError:
+            return False
+
+    def get_shards(self, src):
+        """ Returns the shards of a source directory, lists of top-level directory names
+            which are synced by one rsync call each.
+            Groups listed in the shard file (one shard per line, names separated by tabs)
+            come first, every other top-level directory is a shard of its own.
+        """
+
+        with os.scandir(src) as it:
+            names = sorted(e.name for e in it if e.is_dir(follow_symlinks=False))
+
+        (shards, listed) = (list(), set())
+
+        if self.shard_file:
+            with open(self.shard_file, 'r') as f:
+                for line in f:
+                    group = [n for n in line.rstrip('\n').split('\t') if n in names and n not in listed]
+                    if group:
+                        shards.append(group)
+                        listed.update(group)
+
+        shards.extend([n] for n in names if n not in listed)
+
+        return shards
+
+    def get_rsync_flags(self, dst, backend='hardlink'):
+        """ Returns config.RSYNC_FLAGS for syncing into the backup directory dst.
+            If dst already exists with the hardlink backend, this sync resumes (or repeats) an earlier one,
+            and dst's files can be hard links to older backups. --inplace would write changed files
+            into those shared inodes and change the older backups too, so it's dropped:
+            rsync then writes changed files to a new inode.
+        """
+
+        flags = self.config.RSYNC_FLAGS
+        if backend == 'hardlink' and os.path.exists(dst) and '--inplace' in flags.split():
+            self.logger.info("{} exists, syncing without --inplace to keep older backups intact".format(dst))
+            flags = " ".join(f for f in flags.split() if f != '--inplace')
+
+        return flags
+
+    def run_sharded_sync(self, extra_flags, incremental_basedirs, dst, flags=None, protect=False):
+        """ Syncs the sources into dst with one rsync call per shard (see get_shards()),
+            so rsync's file list (and memory use) is limited to one shard.
+            The first shard of a source is the source directory itself with its top-level files.
+            Completed shards are recorded in the checkpoint file (config.CHECKPOINT_FILE),
+            a failed sync of the same backup continues with the first incomplete shard.
+            flags defaults to config.RSYNC_FLAGS (see get_rsync_flags() for resumed syncs).
+            With protect (copy-on-write backends, which sync with --delete-excluded), the first shard
+            protects the shards' directories in the clone, so it only deletes top-level directories
+            which are gone from the source.
+            Returns the rsync output of all shards.
+        """
+
+        import shlex
+
+        checkpoint_file = os.path.join(self.dst_abs, self.config.CHECKPOINT_FILE)
+        completed = self.load_checkpoint(checkpoint_file, os.path.basename(dst))
+        if completed:
+            self.logger.info("resuming sync of {}, {} shards are already done".format(dst, len(completed)))
+
+        outputs = list()
+
+        for src in self.src_abs:
+            base = os.path.basename(src)
+            shards = self.get_shards(src)
+            excludes = " ".join("--exclude={}".format(shlex.quote(e)) for e in self.excludes)
+            shard_excludes = " ".join("--exclude={}".format(shlex.quote(e))
+                                      for e in CauSync.get_shard_excludes(self.excludes, base))
+            # rsync uses the first matching rule: the excludes, then the protect rules, then the shards' exclude
+            protected = [n for shard in shards for n in shard] if protect else []
+            # (shard key, rsync arguments), the source directory itself comes first
+            jobs = [(src, "{} {} --exclude={} {} {} {}".format(
+                excludes,
+                " ".join("--filter={}".format(shlex.quote("P /{}/{}/".format(base, n))) for n in protected),
+                shlex.quote("/{}/*/".format(base)),
+                " ".join("--link-dest={}".format(shlex.quote(b)) for b in incremental_basedirs),
+                shlex.quote(src),
+                shlex.quote(dst)))]
+
+            for shard in shards:
+                jobs.append(("\t".join([src] + shard), "{} {} {} {}".format(
+                    shard_excludes,
+                    " ".join("--link-dest={}".format(shlex.quote(os.path.join(b, base)))
+                             for b in incremental_basedirs),
+                    " ".join(shlex.quote(os.path.join(src, n)) for n in shard),
+                    shlex.quote(os.path.join(dst, base)))))
+
+            for (key, args) in jobs:
+                if key in completed:
+                    continue
+
+                cmd = "rsync {f} {ef} {args}".format(f=flags if flags else self.config.RSYNC_FLAGS,
+                                                     ef=extra_flags, args=args)
+                self.logger.debug("rsync command is: {}".format(cmd))
+
+                output = self.run_rsync(cmd)
+                outputs.append(output)
+                if not self.progress:
+                    # without progress, the bytes done are only known from rsync's --stats after each shard
+                    self.set_status(bytes_done=self.bytes_done + CauSync.parse_rsync_stats(output).get(
+                        'Total transferred file size', 0))
+                completed.append(key)
+                self.save_checkpoint(checkpoint_file, os.path.basename(dst), completed)
+
+        self.logger.info("synced {} shards".format(len(completed)))
+        if not self.dry_run and os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+
+        return "\n".join(outputs)
+
+    @staticmethod
+    def get_shard_excludes(excludes, base):
+        """ Returns the exclude patterns for the shards of the source base, used by run_sharded_sync().
+            Anchored patterns are relative to the transfer root, which is the source's parent without
+            shards ('/<base>/<shard>/...') and the source itself for a shard ('/<shard>/...'),
+            so they're rewritten. Anchored patterns of other sources are left out.
+        """
+
+        prefix = '/{}/'.format(base)
+        result = list()
+
+        for e in excludes:
+            if not e.startswith('/'):
+                result.append(e)
+            elif e.startswith(prefix) and len(e) > len(prefix):
+                result.append('/' + e[len(prefix):])
+
+        return result
+
+    def load_checkpoint(self, fname, snapshot):
+        """ Returns the completed shard keys of snapshot from the checkpoint file. """
+
+        import json
+
+        try:
+            with open(fname, 'r') as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            return list()
+        except ValueError as e:
+            self.logger.error("ignoring broken checkpoint file {}: {}".format(fname, e))
+            return list()
+
+        if checkpoint.get('snapshot') != snapshot:
+            self.logger.info("checkpoint is for backup {}, starting over".format(checkpoint.get('snapshot')))
+            return list()
+
+        return checkpoint.get('completed', list())
+
+    def save_checkpoint(self, fname, snapshot, completed):
+        """ Atomically writes the completed shard keys of snapshot to the checkpoint file. """
+
+        import json
+
+        if self.dry_run:
+            return
+        with open(fname + '.tmp', 'w') as f:
+            json.dump({'snapshot': snapshot, 'completed': completed}, f)
+        os.replace(fname + '.tmp', fname)
+
+    def get_dirdate(self, dirname):
+        """ Returns the date extracted from a backup directory name.
+            Example: '180410_111237' results in a datetime object for '18-04-10 11:12:37'
+            (if this is the date format in config.py)
+        """
+
+        if isinstance(dirname, datetime):
+            return dirname
+
+        dirdate = parse_dirname(dirname, self.config.DATE_FORMAT)
+        if not dirdate:
+            self.logger.error("'{}' doesn't match format '{}'".format(dirname, self.config.DATE_FORMAT))
+            return False
+
+        return dirdate
+
+    def list_backups(self, dst=None):
+        """ Returns the names of the backups in dst (default: the destination directory) as a sorted tuple.
+            The directory is read with one os.scandir() pass. Backups are directories and packed backups
+            (see pack_snapshot(), their names are recorded in listing_packed), other entries are skipped
+            without a stat() call and counted in listing_skipped. The listing is cached until the directory's
+            mtime changes, so sync, cleanup and check read it once per run.
+        """
+
+        import time
+
+        dst = dst if dst else self.dst_abs
+        mtime = os.stat(dst).st_mtime_ns
+        cached = self.listing_cache.get(dst)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        listed = time.time_ns()
+        (dirnames, packed, skipped) = (set(), set(), 0)
+        with os.scandir(dst) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    dirnames.add(entry.name)
+                elif entry.name.endswith(PACK_SUFFIX) and entry.is_file(follow_symlinks=False):
+                    packed.add(entry.name[:-len(PACK_SUFFIX)])
+                else:
+                    skipped += 1
+
+        # a backup which is still a directory as well wasn't removed completely after packing
+        dirnames = tuple(sorted(dirnames | packed))
+        (self.listing_packed[dst], self.listing_skipped[dst]) = (frozenset(packed), skipped)
+        if listed - mtime > LISTING_RACY_NS:
+            self.listing_cache[dst] = (mtime, dirnames)
+
+        return dirnames
+
+    def count_skipped(self, dst=None):
+        """ Returns how many entries of dst (default: the destination directory) aren't backups:
+            files, symlinks and directories which don't match the date format.
+        """
+
+        dirnames = self.list_backups(dst)
+        return self.listing_skipped[dst if dst else self.dst_abs] + self.get_index(dirnames).skipped
+
+    def get_index(self, dirnames):
+        """ Returns the BackupIndex of a directory listing.
+            The last index is cached, so the retention tiers of one cleanup parse the names only once.
+        """
+
+        if isinstance(dirnames, BackupIndex):
+            return dirnames
+
+        dirnames = tuple(dirnames)
+        cache = self.index_cache
+        if cache and cache[0] == dirnames and cache[1] == self.config.DATE_FORMAT:
+            return cache[2]
+
+        index = BackupIndex(dirnames, self.config.DATE_FORMAT)
+        if index.skipped:
+            self.logger.debug("skipped {} entries which aren't backup directories".format(index.skipped))
+
+        self.index_cache = (dirnames, self.config.DATE_FORMAT, index)
+        return index
+
+    def find_latest_backups(self, dirnames, count=5):
+        """ Returns the latest daily backup directory names.
+            dirnames is a directory listing or a BackupIndex.
+        """
+
+        from itertools import islice
+
+        index = self.get_index(dirnames)
+        packed = self.listing_packed.get(self.dst_abs)
+        # packed backups have no files to link to
+        names = list(islice((i for i in reversed(index.names) if i not in packed), max(count, 0))) \
+            if packed else index.latest(count)
+        # join each one with the destination directory (example: '/path/dest/sourcedir_YYMMHH'
+        return [os.path.join(self.dst_abs, i) for i in names]
+
+    def find_old_backups(self, dirnames, ival='daily', count=5):
+        """ Returns old backups we should delete.
+            The time interval is specified by 'ival'. Values: daily, weekly, monthly, yearly.
+            dirnames is a directory listing or a BackupIndex.
+        """
+
+        multiplier = timedelta(days=self.config.BACKUP_MULTIPLIERS[ival])
+        keepdate = self.curdate - multiplier * count - multiplier
+
+        index = self.get_index(dirnames)
+        # backups after this position are newer than keepdate
+        split = index.position(keepdate)
+
+        (keep, delete) = (list(), list())
+
+        for (pos, d) in enumerate(index.dates()):
+            if ival == 'yearly' and (d.day != 1 or d.month != 1):
+                continue
+            elif ival == 'monthly' and d.day != 1:
+                continue
+            elif ival == 'weekly' and d.weekday() != 0:
+                continue
+            elif pos >= split:
+                keep.append(d)
+            else:
+                delete.append(d)
+
+        delete.sort(reverse=True)
+        keep.sort(reverse=True)
+
+        return keep, delete
+
+    def get_retention(self, dirnames):
+        """ Splits backup directory names (a directory listing or a BackupIndex) into keep and delete dicts.
+            Both dicts map a backup date to the retention tier (yearly, monthly, weekly, daily)
+            which made the decision. You can set how many backups are kept for each tier in config.py.
+        """
+
+        # find_old_backups() works like this:
+        # yearly[0] values are yearly dates we keep AND all backups after that
+        #   (date > now - KEEP_COUNT)
+        #   This results in yearly keep list + the rest of the dates (monthly + weekly + daily)
+        # yearly[1] contains old yearly backups we should delete
+        #   (date < now - KEEP_COUNT)
+        yearly = self.find_old_backups(dirnames, 'yearly', self.config.BACKUPS_TO_KEEP['yearly'])
+        # monthly[0] contains monthly dates we keep AND all backups after that: weekly, daily
+        # monthly[1] contains dates that are less than what we keep, INCLUDING yearly
+        monthly = self.find_old_backups(dirnames, 'monthly', self.config.BACKUPS_TO_KEEP['monthly'])
+        # same logic as above
+        weekly = self.find_old_backups(dirnames, 'weekly', self.config.BACKUPS_TO_KEEP['weekly'])
+        daily = self.find_old_backups(dirnames, 'daily', self.config.BACKUPS_TO_KEEP['daily'])
+
+        # since monthly[1] also contains yearly dates we want to keep,
+        #   we subtract these, the result is a correct monthly delete list
+        monthly = [monthly[0], set(monthly[1]) - set(yearly[0])]
+        # same logic as above, weekly[1] contains yearly and monthly,
+        #   because their date value is less than weekly
+        weekly = [weekly[0], set(weekly[1]) - set(yearly[0]) - set(monthly[0])]
+        daily = [daily[0], set(daily[1]) - set(monthly[0]) - set(weekly[0]) - set(yearly[0])]
+
+        (keep, delete) = (dict(), dict())
+
+        # the first (longest) tier wins, so a yearly backup is reported as yearly
+        #   even though the daily tier would keep it as well
+        for (ival, tier) in (('yearly', yearly), ('monthly', monthly),
+                             ('weekly', weekly), ('daily', daily)):
+            for d in tier[0]:
+                keep.setdefault(d, ival)
+            for d in tier[1]:
+                delete.setdefault(d, ival)
+
+        for d in keep:
+            delete.pop(d, None)
+
+        return keep, delete
+
+    def plan_cleanup(self, dst=None, estimate=True):
+        """ Returns a cleanup plan (dict) without deleting anything.
+            It contains the keep and delete lists, the tier which decided each entry
+            and (if estimate is True) the estimated number of bytes freed by the deletion.
+            The plan can be saved as JSON and executed later with apply_cleanup_plan().
+            dst defaults to the destination directory.
+        """
+
+        dst = dst if dst else self.dst_abs
+
+        try:
+            listdir = self.list_backups(dst)
+        except FileNotFoundError:
+            self.logger.error("Destination directory doesn't exist.")
+            raise CauSyncError("destination directory doesn't exist: {}".format(dst))
+
+        (keep, delete) = self.get_retention(self.get_index(listdir))
+
+        delete_names = [d.strftime(self.config.DATE_FORMAT) for d in sorted(delete)]
+
+        plan = {
+            'destination': dst,
+            'date_format': self.config.DATE_FORMAT,
+            'curdate': self.curdate.isoformat(),
+            'keep': [{'name': d.strftime(self.config.DATE_FORMAT), 'reason': keep[d]}
+                     for d in sorted(keep, reverse=True)],
+            'delete': [{'name': d.strftime(self.config.DATE_FORMAT), 'reason': delete[d]}
+                       for d in sorted(delete, reverse=True)],
+            'bytes_freed': self.estimate_freed_bytes(delete_names, dst) if estimate else None
+        }
+
+        return plan
+
+    def estimate_freed_bytes(self, dirnames, dst=None):
+        """ Estimates how many bytes deleting the backup directories would free.
+            Hard linked files only count if every link to them is inside the deleted directories.
+        """
+
+        dst = dst if dst else self.dst_abs
+
+        # (st_dev, st_ino) -> [links seen, st_nlink, allocated bytes]
+        inodes = dict()
+        freed = 0
+
+        for dirname in dirnames:
+            try:
+                # data shared with newer packed backups is moved, not freed, so this is an upper bound
+                freed += os.lstat(os.path.join(dst, dirname + PACK_SUFFIX)).st_blocks * 512
+            except FileNotFoundError:
+                pass
+            for root, dirs, files in os.walk(os.path.join(dst, dirname)):
+                for name in dirs + files:
+                    try:
+                        st = os.lstat(os.path.join(root, name))
+                    except FileNotFoundError:
+                        continue
+                    # directories can't be hard linked, they are always freed with the tree
+                    if S_ISDIR(st.st_mode):
+                        freed += st.st_blocks * 512
+                        continue
+                    key = (st.st_dev, st.st_ino)
+                    if key in inodes:
+                        inodes[key][0] += 1
+                    else:
+                        inodes[key] = [1, st.st_nlink, st.st_blocks * 512]
+
+        for (seen, nlink, size) in inodes.values():
+            if seen >= nlink:
+                freed += size
+
+        return freed
+
+    def load_cleanup_plan(self, fname):
+        """ Loads a JSON cleanup plan created by 'cleanup --plan'. """
+
+        import json
+
+        try:
+            with open(fname, 'r') as f:
+                plan = json.load(f)
+        except (IOError, ValueError) as e:
+            self.logger.error("can't load cleanup plan {}: {}".format(fname, e))
+            raise CauSyncError(e)
+
+        if plan.get('destination') != self.dst_abs:
+            self.logger.error("cleanup plan {} was made for {}, not {}".format(
+                fname, plan.get('destination'), self.dst_abs))
+            raise CauSyncError("cleanup plan is for another destination")
+
+        return plan
+
+    def get_plan_dirnames(self, plan):
+        """ Returns the validated backup directory names from a cleanup plan's delete list, oldest first.
+            Names which aren't backups of the plan's destination (see list_backups()) are skipped.
+        """
+
+        date_format = plan.get('date_format', self.config.DATE_FORMAT)
+        try:
+            backups = set(self.list_backups(plan['destination']))
+        except FileNotFoundError:
+            self.logger.error("Destination directory doesn't exist.")
+            raise CauSyncError("destination directory doesn't exist: {}".format(plan['destination']))
+
+        dirnames = list()
+
+        for entry in plan['delete']:
+            name = entry['name']
+            # never let a plan point outside of the destination directory
+            if name in ('', '.', '..') or os.path.basename(name) != name:
+                self.logger.error("skipping invalid directory name in cleanup plan: {}".format(name))
+                continue
+            # and only delete backups
+            if name not in backups or not parse_dirname(name, date_format):
+                self.logger.error("skipping {} in cleanup plan, it isn't a backup".format(name))
+                continue
+            dirnames.append(name)
+
+        return sorted(dirnames, key=lambda name: parse_dirname(name, date_format))
+
+    def apply_cleanup_plan(self, plan):
+        """ Deletes exactly the backup directories listed in the plan's delete list.
+            Returns the deleted directory names.
+        """
+
+        dirnames = self.get_plan_dirnames(plan)
+        self.set_status('cleanup')
+
+        self.logger.info("applying cleanup plan: deleting {} backups".format(len(dirnames)))
+        self.rmtree(dirnames, plan['destination'])
+
+        self.logger.info("successfully deleted old backups")
+
+        if self.config.DEDUP_POOL:
+            self.gc_pool()
+
+        return dirnames
+
+    def run_cleanup(self):
+        """ Deletes old backups.
+            You can set how many you want to keep for each date/time interval in config.py.
+            This function is executed when the task argument is 'cleanup'.
+        """
+
+        self.apply_cleanup_plan(self.plan_cleanup(estimate=False))
+
+    def find_destinations(self, root):
+        """ Returns the causync destination directories under root (sorted).
+            A directory is a destination if it contains at least one backup directory or packed backup.
+            Backup directories themselves are never descended into, and the search
+            stops at config.DISCOVER_MAX_DEPTH levels below root.
+        """
+
+        destinations = list()
+        # (path, depth) pairs
+        stack = [(root, 0)]
+
+        while stack:
+            (path, depth) = stack.pop()
+            subdirs = list()
+            is_destination = False
+
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            if parse_dirname(entry.name, self.config.DATE_FORMAT):
+                                is_destination = True
+                            else:
+                                subdirs.append(entry.path)
+                        elif entry.name.endswith(PACK_SUFFIX) and entry.is_file(follow_symlinks=False) and \
+                                parse_dirname(entry.name[:-len(PACK_SUFFIX)], self.config.DATE_FORMAT):
+                            # packed backups count the same as backup directories
+                            is_destination = True
+            except OSError as e:
+                self.logger.error(e)
+                continue
+
+            if is_destination:
+                destinations.append(path)
+            elif depth < self.config.DISCOVER_MAX_DEPTH:
+                stack.extend((d, depth + 1) for d in subdirs)
+
+        return sorted(destinations)
+
+    def plan_cleanup_all(self):
+        """ Returns cleanup plans for every destination under the root directory. """
+
+        destinations = self.find_destinations(self.dst_abs)
+        self.logger.info("found {} destinations under {}".format(len(destinations), self.dst_abs))
+
+        return [self.plan_cleanup(d, estimate=self.plan) for d in destinations]
+
+    def run_cleanup_all(self):
+        """ Deletes old backups from every destination under the root directory.
+            This function is executed when the task argument is 'cleanup-all'.
+            Plans are computed in this process, destinations are cleaned up in a thread pool
+            with at most config.CLEANUP_DEVICE_CONCURRENCY destinations per device.
+            The backups of one destination are deleted in one job, oldest first:
+            deleting a packed backup rewrites the newer packs (see remove_pack()).
+            Returns a list of per-destination totals.
+        """
+
+        import subprocess
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.set_status('cleanup-all')
+        plans = self.plan_cleanup_all()
+
+        semaphores = dict()
+        totals = dict()
+        jobs = list()
+
+        for plan in plans:
+            dst = plan['destination']
+            dirnames = self.get_plan_dirnames(plan)
+            dev = os.stat(dst).st_dev
+            if dev not in semaphores:
+                semaphores[dev] = threading.BoundedSemaphore(self.config.CLEANUP_DEVICE_CONCURRENCY)
+
+            totals[dst] = {'destination': dst, 'kept': len(plan['keep']), 'deleted': 0, 'failed': 0}
+            self.logger.info("{}: keeping {}, deleting {} backups".format(dst, len(plan['keep']), len(dirnames)))
+
+            jobs.append((dst, dev, dirnames))
+
+        def delete(job):
+            (dst, dev, dirnames) = job
+            total = totals[dst]
+            with semaphores[dev]:
+                for dirname in dirnames:
+                    try:
+                        self.rmtree([dirname], dst)
+                        total['deleted'] += 1
+                    except (OSError, subprocess.CalledProcessError) as e:
+                        # a failing 'btrfs subvolume delete' only fails this backup
+                        self.logger.error(e)
+                        total['failed'] += 1
+
+            self.logger.info("{}: deleted {} backups ({} failed)".format(dst, total['deleted'], total['failed']))
+
+        with ThreadPoolExecutor(max_workers=self.config.CLEANUP_WORKERS) as pool:
+            list(pool.map(delete, jobs))
+
+        results = [totals[plan['destination']] for plan in plans]
+
+        self.logger.info("cleaned up {} destinations: deleted {} backups ({} failed)".format(
+            len(results), sum(r['deleted'] for r in results), sum(r['failed'] for r in results)))
+
+        if self.config.DEDUP_POOL:
+            self.gc_pool()
+
+        return results
+
+    def rmtree(self, dirnames, dst=None):
+        """ This is actually a wrapper for shutil.rmtree.
+            dirnames can contain datetime objects or backup directory names.
+            dst defaults to the destination directory.
+            btrfs subvolumes are removed with 'btrfs subvolume delete', packed backups with remove_pack().
+        """
+
+        dst = dst if dst else self.dst_abs
+        for d in dirnames:
+            try:
+                if isinstance(d, datetime):
+                    d = d.strftime(self.config.DATE_FORMAT)
+                path = os.path.join(dst, d)
+                if self.dry_run:
+                    pass
+                elif os.path.isfile(path + PACK_SUFFIX):
+                    self.remove_pack(d, dst)
+                    if os.path.isdir(path):
+                        self.remove_backup_dir(path)
+                else:
+                    self.remove_backup_dir(path)
+                self.logger.debug("removed {}".format(path))
+            except FileNotFoundError:
+                pass
+
+    def remove_backup_dir(self, path):
+        """ Removes a backup directory, or a btrfs subvolume with 'btrfs subvolume delete'. """
+
+        import shlex
+        import shutil
+        import subprocess
+
+        if self.is_subvolume(path):
+            subprocess.check_output("btrfs subvolume delete {}".format(shlex.quote(path)), shell=True)
+        else:
+            shutil.rmtree(path)
+
+    def run_verify(self, snapshot=None):
+        """ Verifies a backup against the source directories.
+            This function is executed when the task argument is 'verify'.
+            Only files with a new inode are compared, files hard linked from the previous
+            backup were already verified when that backup was made.
+            Hashes of verified inodes are stored in config.VERIFY_HASHFILE (in the destination directory),
+            so verifying the same backup again skips them.
+            snapshot (backup directory name) defaults to the latest backup.
+            Returns a dict with counts, raises CauSyncError if files mismatch or are missing from the source.
+        """
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        listdir = self.list_backups()
+        index = self.get_index(listdir)
+        snapshot_date = self.get_dirdate(snapshot) if snapshot else None
+        # the backup to verify is the last one, the one before it is the previous backup
+        names = index.older_than(snapshot_date) if snapshot_date else index.names
+
+        if not names or (snapshot and names[-1] != snapshot):
+            self.logger.error("no backup to verify in {}".format(self.dst_abs))
+            raise CauSyncError("no backup to verify in {}".format(self.dst_abs))
+
+        snapshot_name = names[-1]
+        if snapshot_name in self.listing_packed.get(self.dst_abs, ()):
+            self.logger.error("{} is packed, use restore to get its files".format(snapshot_name))
+            raise CauSyncError("backup is packed: {}".format(snapshot_name))
+
+        if self.is_cow_backup(self.dst_abs):
+            self.logger.warning("{} isn't a hardlink backup, every file is verified".format(self.dst_abs))
+
+        snapshot = os.path.join(self.dst_abs, snapshot_name)
+        previous = os.path.join(self.dst_abs, names[-2]) if len(names) > 1 else None
+        self.logger.info("verifying {} (previous backup: {})".format(snapshot, previous))
+
+        hashfile = os.path.join(self.dst_abs, self.config.VERIFY_HASHFILE)
+        hashes = self.load_hashes(hashfile)
+        # drop the hashes of deleted backups
+        hashes = dict((k, v) for k, v in hashes.items() if k in listdir)
+        known = hashes.setdefault(snapshot_name, dict())
+
+        result = {'snapshot': snapshot, 'verified': 0, 'linked': 0, 'cached': 0,
+                  'mismatched': [], 'missing': []}
+        jobs = list()
+
+        for src in self.src_abs:
+            snapshot_root = os.path.join(snapshot, os.path.basename(src))
+            for root, dirs, files in os.walk(snapshot_root):
+                relroot = os.path.relpath(root, snapshot)
+                for name in files:
+                    path = os.path.join(root, name)
+                    st = os.lstat(path)
+                    if not S_ISREG(st.st_mode):
+                        continue
+
+                    if previous and self.is_same_inode(st, os.path.join(previous, relroot, name)):
+                        result['linked'] += 1
+                        continue
+
+                    if known.get(str(st.st_ino), [None])[:2] == [st.st_size, st.st_mtime_ns]:
+                        result['cached'] += 1
+                        continue
+
+                    source = os.path.join(os.path.dirname(src), relroot, name)
+                    jobs.append((path, source, st))
+
+        self.logger.info("hashing {} new files ({} hard linked, {} already verified)".format(
+            len(jobs), result['linked'], result['cached']))
+
+        chunk_size = self.config.VERIFY_CHUNK_SIZE
+
+        def verify(job):
+            (path, source, st) = job
+            digest = CauSync.hash_file(path, chunk_size)
+            try:
+                return job, digest, CauSync.hash_file(source, chunk_size)
+            except FileNotFoundError:
+                return job, digest, None
+
+        with ThreadPoolExecutor(max_workers=self.config.VERIFY_WORKERS) as pool:
+            for ((path, source, st), digest, source_digest) in pool.map(verify, jobs):
+                if source_digest is None:
+                    self.logger.warning("missing from source: {}".format(source))
+                    result['missing'].append(path)
+                elif digest != source_digest:
+                    self.logger.error("checksum mismatch: {} != {}".format(path, source))
+                    result['mismatched'].append(path)
+                else:
+                    known[str(st.st_ino)] = [st.st_size, st.st_mtime_ns, digest]
+                    result['verified'] += 1
+
+        self.save_hashes(hashfile, hashes)
+
+        self.logger.info("verify finished: {} verified, {} hard linked, {} cached, {} mismatched, {} missing".format(
+            result['verified'], result['linked'], result['cached'],
+            len(result['mismatched']), len(result['missing'])))
+
+        if result['mismatched'] or result['missing']:
+            raise CauSyncError("verify failed: {} mismatched, {} missing".format(
+                len(result['mismatched']), len(result['missing'])))
+
+        return result
+
+    def run_diff(self, out=None):
+        """ Prints the differences between two backups to out (default: stdout).
+            This function is executed when the task argument is 'diff',
+            the first backup is the source argument, the second is the destination.
+            Each line is '<status> <bytes> <path>', status is '+' (added), '-' (removed) or 'M' (modified).
+            Returns the totals.
+        """
+
+        out = out if out else sys.stdout
+        (a, b) = (self.src_abs[0], self.dst_abs)
+        totals = {'added': [0, 0], 'removed': [0, 0], 'modified': [0, 0]}
+        names = {'+': 'added', '-': 'removed', 'M': 'modified'}
+
+        # a missing backup would look empty and every file of the other one would be listed
+        for path in (a, b):
+            if not os.path.isdir(path):
+                packed = os.path.isfile(path + PACK_SUFFIX)
+                self.logger.error("{} isn't a backup directory{}".format(
+                    path, " (it's packed, use restore to get its files)" if packed else ""))
+                raise CauSyncError("no such backup: {}".format(path))
+
+        if self.is_cow_backup(a) or self.is_cow_backup(b):
+            self.logger.error("diff compares inodes and needs backups created by the hardlink backend")
+            raise CauSyncError("diff compares inodes and needs backups created by the hardlink backend")
+
+        self.logger.info("comparing {} to {}".format(a, b))
+
+        for (status, path, size) in self.diff_backups(a, b):
+            out.write("{} {} {}\n".format(status, size, path))
+            total = totals[names[status]]
+            total[0] += 1
+            total[1] += size
+
+        self.logger.info("diff finished: {} added ({} bytes), {} removed ({} bytes), {} modified ({} bytes)".format(
+            totals['added'][0], totals['added'][1], totals['removed'][0], totals['removed'][1],
+            totals['modified'][0], totals['modified'][1]))
+
+        return totals
+
+    def diff_backups(self, a, b):
+        """ Generator comparing backup directories a and b.
+            Unchanged files are hard links to the same inode, so comparing the device, inode,
+            size and mtime of the entries is enough, file contents are never read.
+            Directories are compared in config.DIFF_WORKERS threads, memory use depends on
+            the size of the largest directory, not on the size of the tree.
+            Yields (status, relative path, bytes) tuples, status is '+', '-' or 'M'.
+        """
+
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+        # (relative path, exists in a, exists in b), depth first to keep the queue short
+        queue = deque([('', True, True)])
+        max_pending = self.config.DIFF_WORKERS * 4
+
+        with ThreadPoolExecutor(max_workers=self.config.DIFF_WORKERS) as pool:
+            pending = set()
+            while queue or pending:
+                while queue and len(pending) < max_pending:
+                    pending.add(pool.submit(CauSync.diff_dir, a, b, *queue.pop()))
+
+                (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    (records, subdirs) = f.result()
+                    queue.extend(subdirs)
+                    for r in records:
+                        yield r
+
+    @staticmethod
+    def diff_dir(a, b, rel, in_a, in_b):
+        """ Compares one directory of two backups, used by diff_backups().
+            Returns the records of the directory and the subdirectories to compare next.
+        """
+
+        def scan(root):
+            try:
+                with os.scandir(os.path.join(root, rel)) as it:
+                    return dict((e.name, e) for e in it)
+            except FileNotFoundError:
+                return dict()
+
+        def size(entry):
+            try:
+                return entry.stat(follow_symlinks=False).st_size
+            except FileNotFoundError:
+                return 0
+
+        def key(entry):
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                return None
+            return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+        entries_a = scan(a) if in_a else dict()
+        entries_b = scan(b) if in_b else dict()
+        (records, subdirs) = (list(), list())
+
+        for name in sorted(set(entries_a) | set(entries_b)):
+            path = os.path.join(rel, name)
+            (ea, eb) = (entries_a.get(name), entries_b.get(name))
+            dir_a = ea is not None and ea.is_dir(follow_symlinks=False)
+            dir_b = eb is not None and eb.is_dir(follow_symlinks=False)
+
+            if dir_a or dir_b:
+                subdirs.append((path, dir_a, dir_b))
+                # a file replaced by a directory or the other way around
+                if ea is not None and not dir_a:
+                    records.append(('-', path, size(ea)))
+                if eb is not None and not dir_b:
+                    records.append(('+', path, size(eb)))
+            elif ea is None:
+                records.append(('+', path, size(eb)))
+            elif eb is None:
+                records.append(('-', path, size(ea)))
+            elif ea.inode() != eb.inode() or key(ea) != key(eb):
+                records.append(('M', path, size(eb)))
+
+        return records, subdirs
+
+    def get_pool_key(self, path, st):
+        """ Returns the content store key of a file: its sha256 hash and the metadata hard links share
+            (mode, owner, mtime), files are only merged if all of these match.
+        """
+        return "{}-{:o}-{}-{}-{}".format(CauSync.hash_file(path, self.config.VERIFY_CHUNK_SIZE),
+                                          st.st_mode, st.st_uid, st.st_gid, st.st_mtime_ns)
+
+    def run_dedup(self, snapshot=None):
+        """ Deduplicates the new files of a backup against the shared content store (config.DEDUP_POOL).
+            It runs after sync if DEDUP_POOL is set. Files with a single link (new in this backup)
+            are hashed in config.VERIFY_WORKERS threads. If the store already has the same file, the backup's
+            file is replaced with a hard link to it, otherwise the file is added to the store.
+            snapshot (backup directory name) defaults to the latest backup.
+            Returns (deduplicated files, added files, bytes saved).
+        """
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        pool = self.config.DEDUP_POOL
+        if snapshot is None:
+            latest = self.find_latest_backups(self.list_backups(), 1)
+            if not latest:
+                return 0, 0, 0
+            snapshot = latest[0]
+        else:
+            snapshot = os.path.join(self.dst_abs, snapshot)
+
+        CauSync.makedirs(pool)
+        if os.stat(pool).st_dev != os.stat(snapshot).st_dev:
+            self.logger.error("the content store {} isn't on the same filesystem as {}".format(pool, snapshot))
+            return 0, 0, 0
+
+        if self.is_cow_backup(snapshot):
+            self.logger.warning("{} isn't a hardlink backup, every file is hashed".format(snapshot))
+
+        self.set_status('dedup')
+        link_max = self.get_link_max(pool)
+        candidates = list()
+
+        for root, dirs, files in os.walk(snapshot):
+            for name in files:
+                path = os.path.join(root, name)
+                st = os.lstat(path)
+                if S_ISREG(st.st_mode) and st.st_nlink == 1 and st.st_size >= self.config.DEDUP_MIN_SIZE:
+                    candidates.append((path, st))
+
+        self.logger.info("deduplicating {} new files of {}".format(len(candidates), snapshot))
+
+        (deduplicated, added, saved) = (0, 0, 0)
+
+        with ThreadPoolExecutor(max_workers=self.config.VERIFY_WORKERS) as executor:
+            keys = executor.map(lambda c: self.get_pool_key(*c), candidates)
+
+            for ((path, st), key) in zip(candidates, keys):
+                entry = os.path.join(pool, key[:2], key[2:4], key)
+                CauSync.makedirs(os.path.dirname(entry))
+                try:
+                    # a new entry, the backup's file becomes the stored copy
+                    os.link(path, entry)
+                    added += 1
+                    continue
+                except FileExistsError:
+                    pass
+
+                try:
+                    if os.lstat(entry).st_nlink >= link_max - 1:
+                        continue
+                    tmp = "{}.causync-dedup".format(path)
+                    os.link(entry, tmp)
+                    os.replace(tmp, path)
+                    deduplicated += 1
+                    saved += st.st_blocks * 512
+                except OSError as e:
+                    self.logger.error("can't deduplicate {}: {}".format(path, e))
+
+        self.logger.info("deduplicated {} files ({} bytes), added {} files to the content store".format(
+            deduplicated, saved, added))
+
+        return deduplicated, added, saved
+
+    def gc_pool(self):
+        """ Removes the content store entries which no backup links to anymore.
+            With dry_run it only counts them. Returns (removed entries, freed bytes).
+        """
+
+        pool = self.config.DEDUP_POOL
+        (removed, freed) = (0, 0)
+
+        for root, dirs, files in os.walk(pool):
+            for name in files:
+                path = os.path.join(root, name)
+                st = os.lstat(path)
+                if st.st_nlink == 1:
+                    if not self.dry_run:
+                        os.remove(path)
+                    removed += 1
+                    freed += st.st_blocks * 512
+
+        self.logger.info("removed {} unused files ({} bytes) from the content store".format(removed, freed))
 
-    def __init__(self, config, src, dst, task, no_incremental=False, quiet=False,
-                 dry_run=False, selfname="causync.py", excludes=None, exclude_from=False,
-                 loglevel=None, verbose=False, pidfile=None, cleanup=False, logfile=None):
+        return removed, freed
 
-        self.config = config
-        self.name = selfname
-        self.pid = os.getpid()
-        if pidfile:
-            self.config.PIDFILE = pidfile
+    def get_link_max(self, path):
+        """ Returns the hard link limit of the filesystem of path (config.LINK_MAX overrides it). """
+        if self.config.LINK_MAX:
+            return self.config.LINK_MAX
+        try:
+            return os.pathconf(path, 'PC_LINK_MAX')
+        except (OSError, ValueError):
+            # ext4's limit
+            return 65000
+
+    def find_near_limit_inodes(self, snapshot):
+        """ Returns {(st_dev, st_ino): [paths]} for the files of a backup whose link count is close
+            to the filesystem's hard link limit (config.LINK_REBASE_RATIO of it),
+            the paths are all links of the inode inside the backup.
+            rsync can't use these for --link-dest once the limit is reached and copies them instead.
+        """
 
-        if logfile:
-            self.config.LOGFILE = logfile
+        threshold = int(self.get_link_max(snapshot) * self.config.LINK_REBASE_RATIO)
+        inodes = dict()
+
+        for root, dirs, files in os.walk(snapshot):
+            for name in files:
+                path = os.path.join(root, name)
+                st = os.lstat(path)
+                if S_ISREG(st.st_mode) and st.st_nlink >= threshold:
+                    inodes.setdefault((st.st_dev, st.st_ino), []).append(path)
+
+        return inodes
+
+    def run_rebase(self):
+        """ Replaces files close to the hard link limit in the latest backup with fresh copies.
+            This function is executed when the task argument is 'rebase'.
+            The next sync hard links to the fresh copies, older backups keep the old inodes.
+            Links of the same inode inside the latest backup are kept, they all point to the one fresh copy.
+            With dry_run it only counts the near-limit inodes.
+            Returns the number of near-limit inodes.
+        """
 
-        self.no_incremental = no_incremental
-        self.excludes = excludes if excludes else []
-        if exclude_from:
-            self.excludes = self.excludes + CauSync.parse_exclude_file(exclude_from)
+        from shutil import copy2
 
-        self.src = src
-        self.src_abs = self.parse_src(self.src)
-        if not self.src_abs:
-            exit(-1)
+        latest = self.find_latest_backups(self.list_backups(), 1)
+        if not latest:
+            self.logger.info("no backups in {}, nothing to rebase".format(self.dst_abs))
+            return 0
 
-        self.dst = dst
-        self.dst_abs = os.path.realpath(dst)
+        self.set_status('rebase')
+        inodes = self.find_near_limit_inodes(latest[0])
+        self.logger.info("{}: {} inodes are close to the hard link limit".format(self.dst_abs, len(inodes)))
 
-        self.task = task
-        self.quiet = quiet
-        self.dry_run = dry_run
-        self.cleanup = cleanup
+        if self.dry_run:
+            return len(inodes)
 
-        self.curdate = datetime.now()
-        self.logger = self.get_logger(loglevel, verbose, self.config.LOGFILE)
-        signal.signal(signal.SIGINT, self.signal_handler)
-        signal.signal(signal.SIGTERM, self.signal_handler)
+        for paths in inodes.values():
+            # one fresh copy per inode, the other links of the inode in this backup are linked to it
+            tmps = ["{}.causync-rebase".format(path) for path in paths]
+            st = os.lstat(paths[0])
+            try:
+                copy2(paths[0], tmps[0])
+                try:
+                    os.chown(tmps[0], st.st_uid, st.st_gid)
+                except PermissionError:
+                    pass
+                for tmp in tmps[1:]:
+                    os.link(tmps[0], tmp)
+                for (path, tmp) in zip(paths, tmps):
+                    os.replace(tmp, path)
+                self.logger.debug("rebased {}".format(", ".join(paths)))
+            except OSError as e:
+                self.logger.error("can't rebase {}: {}".format(paths[0], e))
+                for tmp in tmps:
+                    if os.path.lexists(tmp):
+                        os.remove(tmp)
+
+        self.logger.info("rebased {} inodes in {}".format(len(inodes), latest[0]))
+
+        return len(inodes)
+
+    def run_pack(self):
+        """ Packs the backups older than config.PACK_AFTER_DAYS days into indexed archives (see pack_snapshot()).
+            This function is executed when the task argument is 'pack'.
+            They're packed oldest first, so each archive can share data with the previous packed backup.
+            The --link-dest bases are never packed. With dry_run it only lists them.
+            Returns the names of the packed backups.
+        """
 
-    def parse_src(self, src):
-        """ Parses source directory arguments into a list. """
-        if isinstance(src, list):
-            return [os.path.realpath(i) for i in src]
-        elif type(src) == str:
-            return [os.path.realpath(src)]
-        else:
-            self.logger.error("source directory type error")
-            return False
+        index = self.get_index(self.list_backups())
+        packed = self.listing_packed.get(self.dst_abs, frozenset())
+        in_use = set(os.path.basename(i) for i in self.find_latest_backups(
+            index, self.config.BACKUPS_LINK_DEST_COUNT))
 
-    def run(self):
-        """ Main run function. """
+        self.set_status('pack')
+        (done, neighbour) = (list(), None)
 
-        pidfile_exists = os.path.isfile(self.config.PIDFILE)
-        is_running = self.is_running() if self.config.CHECK_PGREP else False
+        for name in index.older_than(self.curdate - timedelta(days=self.config.PACK_AFTER_DAYS)):
+            if name in packed:
+                # finish packing runs which were interrupted after writing the archive
+                if os.path.isdir(os.path.join(self.dst_abs, name)) and not self.dry_run:
+                    self.remove_backup_dir(os.path.join(self.dst_abs, name))
+                neighbour = name
+                continue
+            if name in in_use:
+                continue
 
-        self.logger.info("started with PID {}".format(self.pid))
-        self.logger.info("Excludes: {}".format(self.excludes))
+            self.logger.info("packing {} (previous packed backup: {})".format(name, neighbour))
+            if not self.dry_run:
+                self.pack_snapshot(name, neighbour)
+                neighbour = name
+            done.append(name)
 
-        if len(self.src_abs) > 1:
-            self.logger.info("syncing multiple source directories")
+        self.logger.info("packed {} backups in {}".format(len(done), self.dst_abs))
 
-        if self.dry_run:
-            self.logger.info("doing dry run")
+        if self.config.DEDUP_POOL and done and not self.dry_run:
+            self.gc_pool()
 
-        if self.task == 'cleanup':
-            try:
-                self.create_pidfile()
-                self.run_cleanup()
-            finally:
-                self.remove_pidfile()
+        return done
 
-        elif self.task in ['check', 'sync']:
+    def pack_snapshot(self, name, neighbour=None):
+        """ Converts a backup directory into a single archive: '<name>.pack' in the destination directory.
+            The archive is a zip file. Its central directory is the random-access member index,
+            'data/<sha256>' members hold file contents (each one once) and 'index.jsonl' lists every path
+            sorted, one JSON list per line: [path, type ('d', 'f' or 'l'), mode, uid, gid, mtime_ns, size,
+            sha256 or symlink target, name of the packed backup storing the content (None: this one)].
+            Contents already stored by the neighbour packed backup (or the one it refers to) aren't stored again.
+            Files with the neighbour's size and mtime (rsync's quick check) reuse its hash, others are hashed.
+            Returns (entries, stored contents, shared contents).
+        """
 
-            if pidfile_exists or is_running:
-                self.logger.info(
-                    "causync is already running on {} or the default pidfile exists".format(", ".join(self.src_abs)))
-            else:
-                self.logger.info("causync is not running yet on {}".format(", ".join(self.src_abs)))
-                if self.task == 'sync':
-                    try:
-                        self.create_pidfile()
-                        self.run_sync()
-                        if self.cleanup:
-                            self.run_cleanup()
-                    finally:
-                        self.remove_pidfile()
+        import json
+        import zipfile
 
-    def signal_handler(self, signum, frame):
-        self.logger.info("received SIGINT ({}, {}), removing PIDFILE".format(signum, frame))
-        self.remove_pidfile()
+        path = os.path.join(self.dst_abs, name)
+        (pack, tmp) = (path + PACK_SUFFIX, path + PACK_SUFFIX + ".tmp")
 
-    def create_pidfile(self):
-        self.logger.debug("creating pidfile {}".format(self.config.PIDFILE))
-        try:
-            with open(self.config.PIDFILE, 'w') as f:
-                f.write(str(self.pid))
-        except IOError as e:
-            self.logger.error(e)
-            exit(-1)
+        # path -> neighbour's entry, content hash -> the packed backup storing it
+        (previous, owners) = (dict(), dict())
+        if neighbour:
+            for entry in self.load_pack_index(neighbour):
+                previous[entry[0]] = entry
+                if entry[1] == 'f':
+                    owners[entry[7]] = entry[8] if entry[8] else neighbour
+
+        (entries, stored, shared) = (list(), set(), 0)
 
-    def remove_pidfile(self):
-        self.logger.debug("removing pidfile {}".format(self.config.PIDFILE))
         try:
-            os.remove(self.config.PIDFILE)
-        except IOError as e:
-            self.logger.error(e)
-            exit(-1)
+            with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_STORED, allowZip64=True, strict_timestamps=False) as zf:
+                for root, dirs, files in os.walk(path):
+                    for fname in dirs + files:
+                        full = os.path.join(root, fname)
+                        st = os.lstat(full)
+                        entry = [os.path.relpath(full, path).replace(os.sep, '/'), None, S_IMODE(st.st_mode),
+                                 st.st_uid, st.st_gid, st.st_mtime_ns, st.st_size, None, None]
+
+                        if S_ISDIR(st.st_mode):
+                            entry[1] = 'd'
+                        elif S_ISLNK(st.st_mode):
+                            (entry[1], entry[7]) = ('l', os.readlink(full))
+                        elif S_ISREG(st.st_mode):
+                            entry[1] = 'f'
+                            old = previous.get(entry[0])
+                            if old and old[1] == 'f' and old[5:7] == entry[5:7]:
+                                entry[7] = old[7]
+                            else:
+                                entry[7] = CauSync.hash_file(full, self.config.VERIFY_CHUNK_SIZE)
+
+                            if entry[7] in owners:
+                                entry[8] = owners[entry[7]]
+                                shared += 1
+                            elif entry[7] not in stored:
+                                zf.write(full, "data/" + entry[7])
+                                stored.add(entry[7])
+                        else:
+                            self.logger.warning("can't pack special file {}, skipping it".format(full))
+                            continue
+
+                        entries.append(entry)
+
+                entries.sort(key=lambda e: e[0])
+                zf.writestr("index.jsonl", "".join(json.dumps(e) + "\n" for e in entries))
+
+            # the backup directory is removed next, the archive has to be on disk
+            with open(tmp, 'rb') as f:
+                os.fsync(f.fileno())
+            os.replace(tmp, pack)
+        except BaseException:
+            # no half-written archives in the destination
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        self.remove_backup_dir(path)
+
+        self.logger.info("packed {}: {} entries, {} contents stored, {} shared with older packed backups".format(
+            name, len(entries), len(stored), shared))
+
+        return len(entries), len(stored), shared
+
+    def load_pack_index(self, name, dst=None):
+        """ Yields the index entries of a packed backup (see pack_snapshot()), sorted by path. """
+
+        import json
+        import zipfile
+
+        dst = dst if dst else self.dst_abs
+        with zipfile.ZipFile(os.path.join(dst, name + PACK_SUFFIX)) as zf:
+            with zf.open("index.jsonl") as f:
+                for line in f:
+                    yield json.loads(line)
+
+    def remove_pack(self, name, dst=None):
+        """ Removes a packed backup.
+            Contents newer packed backups share with it are moved into the oldest of them first,
+            and the rest of them are pointed to that one.
+        """
 
-    def run_sync(self):
-        """ This is the backup function.
-            It is executed when the task argument is 'sync'.
+        dst = dst if dst else self.dst_abs
+        self.list_backups(dst)
+        newer = BackupIndex(self.listing_packed.get(dst, ()), self.config.DATE_FORMAT)
+        date = parse_dirname(name, self.config.DATE_FORMAT)
+        # content hash -> the packed backup which stores it now
+        moved = dict()
+
+        for other in (newer.names[newer.position(date):] if date else []):
+            entries = list(self.load_pack_index(other, dst))
+            if any(e[8] == name for e in entries):
+                self.rewrite_pack(other, entries, name, moved, dst)
+
+        os.remove(os.path.join(dst, name + PACK_SUFFIX))
+
+    def rewrite_pack(self, name, entries, removed, moved, dst=None):
+        """ Rewrites a packed backup, so none of its entries refer to the packed backup 'removed'.
+            Contents in moved (content hash -> packed backup) are referred to there,
+            the rest are copied from 'removed' and added to moved.
         """
 
-        # self.curdate = datetime.now().strftime(self.config.DATE_FORMAT)
-        extra_flags = ""
+        import json
+        import shutil
+        import zipfile
 
-        if self.dry_run:
-            extra_flags += " -n "
+        dst = dst if dst else self.dst_abs
+        (pack, tmp) = (os.path.join(dst, name + PACK_SUFFIX), os.path.join(dst, name + PACK_SUFFIX + ".tmp"))
+        adopted = set()
 
-        if self.excludes:
-            for e in self.excludes:
-                extra_flags += " --exclude={} ".format(e)
+        try:
+            with zipfile.ZipFile(pack) as old, zipfile.ZipFile(os.path.join(dst, removed + PACK_SUFFIX)) as gone, \
+                    zipfile.ZipFile(tmp, 'w', zipfile.ZIP_STORED, allowZip64=True, strict_timestamps=False) as zf:
+                for info in old.infolist():
+                    if info.filename != "index.jsonl":
+                        with old.open(info) as r, zf.open(info.filename, 'w', force_zip64=True) as w:
+                            shutil.copyfileobj(r, w)
+
+                for entry in entries:
+                    if entry[8] != removed:
+                        continue
+                    if entry[7] in moved:
+                        entry[8] = moved[entry[7]]
+                        continue
+                    if entry[7] not in adopted:
+                        with gone.open("data/" + entry[7]) as r, \
+                                zf.open("data/" + entry[7], 'w', force_zip64=True) as w:
+                            shutil.copyfileobj(r, w)
+                        adopted.add(entry[7])
+                    entry[8] = None
+
+                zf.writestr("index.jsonl", "".join(json.dumps(e) + "\n" for e in entries))
+
+            with open(tmp, 'rb') as f:
+                os.fsync(f.fileno())
+            os.replace(tmp, pack)
+        except BaseException:
+            # no half-written archives in the destination
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        moved.update((i, name) for i in adopted)
+
+        self.logger.debug("moved {} contents from {} to {}".format(len(adopted), removed, name))
+
+    def run_restore(self, snapshot, member, output=None):
+        """ Restores one file of a backup to output (default: stdout).
+            This function is executed when the task argument is 'restore'.
+            Packed backups aren't unpacked: the path is looked up in the archive's index
+            and only the file's data member is read.
+        """
 
-        CauSync.makedirs(self.dst_abs)
+        import shutil
+        import zipfile
 
-        if not self.no_incremental:
-            incremental_basedirs = self.find_latest_backups(os.listdir(self.dst_abs),
-                                                            self.config.BACKUPS_LINK_DEST_COUNT)
-            if incremental_basedirs:
-                self.logger.debug("inc_basedirs={}".format(incremental_basedirs))
-                self.logger.info("found incremental basedirs, using them in --link-dest")
+        member = member.strip('/')
+        path = os.path.join(self.dst_abs, snapshot)
+        self.list_backups()
 
-                for basedir in incremental_basedirs:
-                    extra_flags += " --link-dest={} ".format(basedir)
+        if snapshot not in self.listing_packed.get(self.dst_abs, ()):
+            source = os.path.join(path, member)
+            if not os.path.isfile(source):
+                self.logger.error("{} isn't a file in {}".format(member, path))
+                raise CauSyncError("file not found: {}".format(source))
+            if output:
+                shutil.copy2(source, output)
             else:
-                self.logger.info("incremental basedirs not found, skipping --link-dest")
+                with open(source, 'rb') as r:
+                    shutil.copyfileobj(r, sys.stdout.buffer)
+            return
+
+        entry = None
+        for e in self.load_pack_index(snapshot):
+            # the index is sorted, so we can stop at the first path after member
+            if e[0] >= member:
+                entry = e if e[0] == member else None
+                break
+
+        if not entry or entry[1] != 'f':
+            self.logger.error("{} isn't a file in {}".format(member, path + PACK_SUFFIX))
+            raise CauSyncError("file not found: {}".format(member))
+
+        owner = entry[8] if entry[8] else snapshot
+        with zipfile.ZipFile(os.path.join(self.dst_abs, owner + PACK_SUFFIX)) as zf:
+            with zf.open("data/" + entry[7]) as r:
+                if not output:
+                    shutil.copyfileobj(r, sys.stdout.buffer)
+                    return
+                with open(output, 'wb') as w:
+                    shutil.copyfileobj(r, w)
+
+        os.chmod(output, entry[2])
+        os.utime(output, ns=(entry[5], entry[5]))
+        self.logger.info("restored {} from {} to {}".format(member, snapshot, output))
+
+    def run_send(self, snapshot, base=None, out=None):
+        """ Writes a replication stream of a backup to out (a binary file, default: stdout).
+            This function is executed when the task argument is 'send'.
+            The stream starts with STREAM_MAGIC and a JSON header line, then one JSON record per line
+            (see send_dir()), and ends with an 'end' record holding the counts. Files whose inode
+            is the same at the same path in the base backup are sent as links, so the stream
+            (and the time and memory it takes) grows with the change since base, not with the history.
+            Without base every file is sent with its data. Returns the counts.
+        """
 
-        dst = os.path.realpath(os.path.join(self.dst_abs, self.curdate.strftime(self.config.DATE_FORMAT)))
-        cmd = "rsync {f} {ef} {src} {dst}".format(f=self.config.RSYNC_FLAGS,
-                                                  ef=extra_flags,
-                                                  src=" ".join(self.src_abs),
-                                                  dst=dst)
+        import json
+
+        out = out if out else sys.stdout.buffer
+        self.list_backups()
+        for name in [snapshot] + ([base] if base else []):
+            if name in self.listing_packed.get(self.dst_abs, ()) or not os.path.isdir(os.path.join(self.dst_abs, name)):
+                self.logger.error("{} isn't a backup directory in {}".format(name, self.dst_abs))
+                raise CauSyncError("no such backup: {}".format(name))
+
+        self.set_status('send')
+        root = os.path.join(self.dst_abs, snapshot)
+        base_root = os.path.join(self.dst_abs, base) if base else None
+        counts = {'files': 0, 'linked': 0, 'bytes': 0}
+
+        out.write(STREAM_MAGIC)
+        out.write(json.dumps({'snapshot': snapshot, 'base': base}).encode() + b"\n")
+        # (st_dev, st_ino) -> path of new inodes with more links, they're sent once
+        self.send_dir(out, root, base_root, '', dict(), counts)
+        out.write(json.dumps(['end', counts]).encode() + b"\n")
+        out.flush()
+
+        self.logger.info("sent {}: {} files ({} bytes), {} links to {}".format(
+            snapshot, counts['files'], counts['bytes'], counts['linked'], base))
+
+        return counts
+
+    def send_dir(self, out, root, base_root, rel, new_inodes, counts):
+        """ Writes the records of one directory of a backup and its subdirectories, used by run_send().
+            Records (JSON lists): ['dir', path] when entering a directory and ['attr', path, mode, uid, gid,
+            mtime_ns] when leaving it, ['file', path, mode, uid, gid, mtime_ns, size] followed by size bytes
+            of data, ['link', path] for a file unchanged in the base backup, ['hardlink', path, first path]
+            for another link of a file sent earlier, and ['symlink', path, target, uid, gid, mtime_ns].
+        """
 
-        self.logger.debug("rsync command is: {}".format(cmd))
-        self.logger.info("syncing {} to {}".format(self.src_abs, dst))
+        import json
+
+        def write(record):
+            out.write(json.dumps(record).encode() + b"\n")
+
+        path = os.path.join(root, rel)
+        st = os.lstat(path)
+        if rel:
+            write(['dir', rel])
+
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda e: e.name)
+
+        for entry in entries:
+            entry_rel = os.path.join(rel, entry.name) if rel else entry.name
+            est = entry.stat(follow_symlinks=False)
+            key = (est.st_dev, est.st_ino)
+
+            if S_ISDIR(est.st_mode):
+                self.send_dir(out, root, base_root, entry_rel, new_inodes, counts)
+            elif S_ISLNK(est.st_mode):
+                write(['symlink', entry_rel, os.readlink(entry.path), est.st_uid, est.st_gid, est.st_mtime_ns])
+            elif not S_ISREG(est.st_mode):
+                self.logger.warning("can't send special file {}, skipping it".format(entry.path))
+            elif base_root and CauSync.is_same_inode(est, os.path.join(base_root, entry_rel)):
+                write(['link', entry_rel])
+                counts['linked'] += 1
+            elif key in new_inodes:
+                write(['hardlink', entry_rel, new_inodes[key]])
+            else:
+                if est.st_nlink > 1:
+                    new_inodes[key] = entry_rel
+                write(['file', entry_rel, S_IMODE(est.st_mode), est.st_uid, est.st_gid, est.st_mtime_ns,
+                       est.st_size])
+                with open(entry.path, 'rb') as f:
+                    left = est.st_size
+                    while left:
+                        chunk = f.read(min(left, 1024 * 1024))
+                        if not chunk:
+                            raise CauSyncError("{} changed while sending it".format(entry.path))
+                        out.write(chunk)
+                        left -= len(chunk)
+                counts['files'] += 1
+                counts['bytes'] += est.st_size
+
+        write(['attr', rel, S_IMODE(st.st_mode), st.st_uid, st.st_gid, st.st_mtime_ns])
+
+    def run_receive(self, inp=None):
+        """ Rebuilds a backup from a replication stream (see run_send()) read from inp (default: stdin).
+            This function is executed when the task argument is 'receive'.
+            Files unchanged since the base backup are hard linked from it with os.link(), so the base
+            has to be in the destination directory already. The backup is built in '<backup>.partial'
+            and only renamed when the whole stream arrived. Returns the counts.
+        """
 
-        result = subprocess.check_output(cmd, shell=True).decode()
-        self.logger.debug(result)
+        import json
+        import shutil
 
-        self.logger.info("sync finished")
+        inp = inp if inp else sys.stdin.buffer
+        if inp.readline() != STREAM_MAGIC:
+            self.logger.error("the input isn't a causync replication stream")
+            raise CauSyncError("invalid stream")
 
-        return result
+        header = json.loads(inp.readline())
+        (snapshot, base) = (header['snapshot'], header['base'])
+        for name in [snapshot] + ([base] if base else []):
+            if name in ('', '.', '..') or os.path.basename(name) != name:
+                self.logger.error("invalid backup name in stream: {}".format(name))
+                raise CauSyncError("invalid stream")
 
-    def get_dirdate(self, dirname):
-        """ Returns the date extracted from a backup directory name.
-            Example: '180410_111237' results in a datetime object for '18-04-10 11:12:37'
-            (if this is the date format in config.py)
-        """
+        CauSync.makedirs(self.dst_abs)
+        final = os.path.join(self.dst_abs, snapshot)
+        (root, base_root) = (final + ".partial", os.path.join(self.dst_abs, base) if base else None)
+        if os.path.lexists(final):
+            self.logger.error("{} already exists".format(final))
+            raise CauSyncError("backup exists: {}".format(final))
+        if base_root and not os.path.isdir(base_root):
+            self.logger.error("the base backup {} isn't in {}".format(base, self.dst_abs))
+            raise CauSyncError("no such backup: {}".format(base))
+
+        self.set_status('receive', 0)
+        if os.path.lexists(root):
+            shutil.rmtree(root)
+        os.mkdir(root)
 
         try:
-            if isinstance(dirname, datetime):
-                return dirname
-            dirdate = datetime.strptime(dirname, self.config.DATE_FORMAT)
-            if not isinstance(dirdate, datetime):
-                return False
+            counts = self.receive_records(inp, root, base_root)
+        except Exception:
+            shutil.rmtree(root, ignore_errors=True)
+            raise
 
-            return dirdate
+        os.rename(root, final)
+        self.logger.info("received {}: {} files ({} bytes), {} links to {}".format(
+            snapshot, counts['files'], counts['bytes'], counts['linked'], base))
 
-        except ValueError as e:
-            self.logger.error(e)
-            return False
+        return counts
 
-    def find_latest_backups(self, dirnames, count=5):
-        """ Returns the latest daily backup directory names. """
+    def receive_records(self, inp, root, base_root):
+        """ Applies the records of a replication stream below root, used by run_receive().
+            Returns the counts of the stream's 'end' record.
+        """
 
-        if len(dirnames) == 0:
-            return []
+        import json
+
+        # relative paths of the directories known to be real directories below root
+        dirs = set([''])
+
+        def target(rel):
+            # never let a stream write outside of the backup: no absolute paths, no '..'
+            # and no path through a symlink, every parent has to be a real directory
+            parts = rel.split('/')
+            if not rel or rel.startswith('/') or '..' in parts or '' in parts:
+                raise CauSyncError("invalid path in stream: {}".format(rel))
+            for i in range(1, len(parts)):
+                parent = '/'.join(parts[:i])
+                if parent in dirs:
+                    continue
+                try:
+                    mode = os.lstat(os.path.join(root, parent)).st_mode
+                except FileNotFoundError:
+                    mode = 0
+                if not S_ISDIR(mode):
+                    raise CauSyncError("invalid path in stream: {}".format(rel))
+                dirs.add(parent)
+            return os.path.join(root, rel)
+
+        def chown(path, uid, gid):
+            # --numeric-ids, like rsync
+            if os.geteuid() == 0:
+                os.chown(path, uid, gid, follow_symlinks=False)
+
+        while True:
+            line = inp.readline()
+            if not line:
+                self.logger.error("the stream ended too early")
+                raise CauSyncError("truncated stream")
+            record = json.loads(line)
+            kind = record[0]
+
+            if kind == 'end':
+                return record[1]
+            elif kind == 'dir':
+                os.mkdir(target(record[1]))
+            elif kind == 'attr':
+                path = target(record[1]) if record[1] else root
+                if not S_ISDIR(os.lstat(path).st_mode):
+                    raise CauSyncError("invalid path in stream: {}".format(record[1]))
+                chown(path, record[3], record[4])
+                os.chmod(path, record[2])
+                os.utime(path, ns=(record[5], record[5]))
+            elif kind == 'link':
+                os.link(os.path.join(base_root, record[1]), target(record[1]), follow_symlinks=False)
+            elif kind == 'hardlink':
+                os.link(target(record[2]), target(record[1]), follow_symlinks=False)
+            elif kind == 'symlink':
+                path = target(record[1])
+                os.symlink(record[2], path)
+                chown(path, record[3], record[4])
+                if os.utime in os.supports_follow_symlinks:
+                    os.utime(path, ns=(record[5], record[5]), follow_symlinks=False)
+            elif kind == 'file':
+                path = target(record[1])
+                try:
+                    # never write through an existing file or symlink
+                    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+                except FileExistsError:
+                    raise CauSyncError("invalid path in stream: {}".format(record[1]))
+                with open(fd, 'wb') as f:
+                    left = record[6]
+                    while left:
+                        chunk = inp.read(min(left, 1024 * 1024))
+                        if not chunk:
+                            raise CauSyncError("truncated stream")
+                        f.write(chunk)
+                        left -= len(chunk)
+                chown(path, record[3], record[4])
+                os.chmod(path, record[2])
+                os.utime(path, ns=(record[5], record[5]))
+                self.bytes_done += record[6]
+            else:
+                raise CauSyncError("unknown record in stream: {}".format(kind))
 
-        # extract dates from directory names and sort them
-        dirdates = []
+    def save_history(self, record):
+        """ Appends a run record (dict) to the destination's run history (config.HISTORY_FILE, JSON lines). """
 
-        for d in dirnames:
-            dd = self.get_dirdate(d)
-            if dd:
-                dirdates.append(dd)
-
-        dirdates.sort(reverse=True)
-
-        # determine list length (if len < delete count, we don't do anything)
-        list_len = count if len(dirdates) >= count else len(dirdates)
-        # get a reverse sorted list of dirdates (descending by date)
-        latest_dates = dirdates[:list_len]
-        # convert them to string for rsync --link-dest (example: datetime obj becomes 'YYMMHH' string)
-        latest_dates = [i.strftime(self.config.DATE_FORMAT) for i in latest_dates]
-        # join each one with the destination directory (example: '/path/dest/sourcedir_YYMMHH'
-        latest_dates = [os.path.join(self.dst_abs, i) for i in latest_dates]
+        import json
 
-        return latest_dates
+        if self.dry_run:
+            return
 
-    def find_old_backups(self, dirnames, ival='daily', count=5):
-        """ Returns old backups we should delete.
-            The time interval is specified by 'ival'. Values: daily, weekly, monthly, yearly.
-        """
+        try:
+            with open(os.path.join(self.dst_abs, self.config.HISTORY_FILE), 'a') as f:
+                f.write(json.dumps(record) + "\n")
+        except IOError as e:
+            self.logger.error("can't save run history: {}".format(e))
 
-        multiplier = timedelta(days=self.config.BACKUP_MULTIPLIERS[ival])
+    def load_history(self):
+        """ Returns the destination's run records, oldest first. Broken lines are skipped. """
 
-        # extract dates from directory names and sort them
-        dirdates = []
+        import json
 
-        for d in dirnames:
-            dd = self.get_dirdate(d)
-            if dd:
-                dirdates.append(dd)
+        history = list()
 
-        dirdates = list(sorted(dirdates))
+        try:
+            with open(os.path.join(self.dst_abs, self.config.HISTORY_FILE), 'r') as f:
+                for line in f:
+                    try:
+                        history.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            pass
 
-        (keep, delete) = (list(), list())
+        return history
 
-        for d in dirdates:
-            m = multiplier * count
-            keepdate = self.curdate - m - multiplier
+    def run_report(self, out=None):
+        """ Prints run history trends to out (default: stdout) and flags regressions.
+            This function is executed when the task argument is 'report'.
+            The mean of each metric in the last config.REPORT_RECENT_DAYS days is compared with its mean in the
+            config.REPORT_BASELINE_DAYS days before. Durations growing or throughput falling by
+            config.REPORT_REGRESSION_RATIO or more are regressions.
+            Returns the list of regression messages.
+        """
 
-            if ival == 'yearly' and (d.day != 1 or d.month != 1):
-                continue
-            elif ival == 'monthly' and d.day != 1:
+        out = out if out else sys.stdout
+        recent_start = self.curdate - timedelta(days=self.config.REPORT_RECENT_DAYS)
+        baseline_start = recent_start - timedelta(days=self.config.REPORT_BASELINE_DAYS)
+
+        # (metric, description, True if bigger is worse)
+        metrics = [('duration', 'sync duration (s)', True),
+                   ('file_list_generation_time', 'file list generation time (s)', True),
+                   ('cleanup_duration', 'cleanup duration (s)', True),
+                   ('files_scanned', 'files scanned', True),
+                   ('bytes_transferred', 'bytes transferred', True),
+                   ('throughput', 'throughput (bytes/s)', False),
+                   ('entries_skipped', 'non-backup entries skipped', True)]
+
+        (baseline, recent) = (dict(), dict())
+
+        for record in self.load_history():
+            if record.get('duration') and record.get('bytes_transferred') is not None:
+                record['throughput'] = record['bytes_transferred'] / record['duration']
+            date = datetime.strptime(record['date'][:19], "%Y-%m-%dT%H:%M:%S")
+            if date >= recent_start:
+                period = recent
+            elif date >= baseline_start:
+                period = baseline
+            else:
                 continue
-            elif ival == 'weekly' and d.weekday() != 0:
+            for (metric, description, bigger_is_worse) in metrics:
+                if record.get(metric) is not None:
+                    period.setdefault(metric, list()).append(record[metric])
+
+        regressions = list()
+        out.write("{:<32}{:>16}{:>16}{:>10}\n".format('metric', 'baseline', 'recent', 'change'))
+
+        for (metric, description, bigger_is_worse) in metrics:
+            if metric not in baseline and metric not in recent:
                 continue
-            else:
-                if d > keepdate:
-                    keep.append(d)
-                else:
-                    delete.append(d)
+            old = sum(baseline[metric]) / len(baseline[metric]) if metric in baseline else None
+            new = sum(recent[metric]) / len(recent[metric]) if metric in recent else None
 
-        delete.sort(reverse=True)
-        keep.sort(reverse=True)
+            change = ''
+            if old and new is not None:
+                ratio = new / old
+                change = "x{:.2f}".format(ratio)
+                limit = self.config.REPORT_REGRESSION_RATIO
+                if (bigger_is_worse and ratio >= limit) or (not bigger_is_worse and ratio <= 1 / limit):
+                    regressions.append("{} went from {:.2f} to {:.2f} (x{:.2f}) in the last {} days".format(
+                        description, old, new, ratio, self.config.REPORT_RECENT_DAYS))
 
-        return keep, delete
+            out.write("{:<32}{:>16}{:>16}{:>10}\n".format(
+                description, '-' if old is None else "{:.2f}".format(old),
+                '-' if new is None else "{:.2f}".format(new), change))
 
-    def run_cleanup(self):
-        """ Deletes old backups.
-            You can set how many you want to keep for each date/time interval in config.py.
-            This function is executed when the task argument is 'cleanup'.
-        """
-        listdir = None
+        for r in regressions:
+            out.write("REGRESSION: {}\n".format(r))
+            self.logger.warning(r)
 
-        try:
-            listdir = os.listdir(self.dst_abs)
-        except FileNotFoundError:
-            self.logger.error("Destination directory doesn't exist.")
-            exit()
+        return regressions
 
-        # find_old_backups() works like this:
-        # yearly[0] values are yearly dates we keep AND all backups after that
-        #   (date > now - KEEP_COUNT)
-        #   This results in yearly keep list + the rest of the dates (monthly + weekly + daily)
-        # yearly[1] contains old yearly backups we should delete
-        #   (date < now - KEEP_COUNT)
-        yearly = self.find_old_backups(listdir, 'yearly', self.config.BACKUPS_TO_KEEP['yearly'])
-        # monthly[0] contains monthly dates we keep AND all backups after that: weekly, daily
-        # monthly[1] contains dates that are less than what we keep, INCLUDING yearly
-        monthly = self.find_old_backups(listdir, 'monthly', self.config.BACKUPS_TO_KEEP['monthly'])
-        # same logic as above
-        weekly = self.find_old_backups(listdir, 'weekly', self.config.BACKUPS_TO_KEEP['weekly'])
-        daily = self.find_old_backups(listdir, 'daily', self.config.BACKUPS_TO_KEEP['daily'])
+    def load_hashes(self, fname):
+        """ Loads the stored hashes, returns an empty dict if there are none. """
 
-        # since monthly[1] also contains yearly dates we want to keep,
-        #   we subtract these, the result is a correct monthly delete list
-        monthly = [monthly[0], set(monthly[1]) - set(yearly[0])]
-        # same logic as above, weekly[1] contains yearly and monthly,
-        #   because their date value is less than weekly
-        weekly = [weekly[0], set(weekly[1]) - set(yearly[0]) - set(monthly[0])]
-        daily = [daily[0], set(daily[1]) - set(monthly[0]) - set(weekly[0]) - set(yearly[0])]
+        import json
 
-        d = set(list(yearly[1]) + list(monthly[1]) + list(weekly[1]) + list(daily[1]))
-        self.rmtree(sorted(d))
+        try:
+            with open(fname, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return dict()
+        except ValueError as e:
+            self.logger.error("ignoring broken hash file {}: {}".format(fname, e))
+            return dict()
 
-        self.logger.info("successfully deleted old backups")
+    def save_hashes(self, fname, hashes):
+        """ Atomically writes the stored hashes. """
 
-    def rmtree(self, dirnames):
-        """ This is actually a wrapper for shutil.rmtree. """
-        for d in dirnames:
-            try:
-                path = os.path.join(self.dst_abs, d.strftime(self.config.DATE_FORMAT))
-                if not self.dry_run:
-                    rmtree(path)
-                self.logger.debug("removed {}".format(path))
-            except FileNotFoundError:
-                pass
+        import json
+
+        if self.dry_run:
+            return
+        with open(fname + '.tmp', 'w') as f:
+            json.dump(hashes, f)
+        os.replace(fname + '.tmp', fname)
 
     def is_running(self):
         """ Tries to guess (from processlist) whether sync
             for the specific source and destination directory is already running.
         """
 
+        import subprocess
+
         cmd = "pgrep -f '[p]ython[23].*{}.*{}.*{}'".format(self.name, " ".join(self.src), self.dst)
 
         try:
@@ -352,12 +2684,28 @@ class CauSync(object):
             self.logger.debug(("command '{}' returned with error "
                                "(code {}): {}").format(e.cmd, e.returncode, e.output))
 
+    def close(self):
+        """ Library API: closes the job's log file, sync() and cleanup() do it when they finish.
+            The file is opened again if the job logs after this.
+        """
+
+        for handler in self.logger.handlers:
+            handler.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def get_logger(self, loglevel=None, verbose=False, logfile=None):
         """ Returns a logger object with the current settings in config.py.
             If the -q (quiet) flag is set, it doesn't log to console.
             If the -v (verbose) flag is set, it increases logging verbosity by one step.
         """
 
+        import logging
+
         # please don't change these numbers
         loglevels = {'debug': 10,
                      'info': 20,
@@ -373,12 +2721,15 @@ class CauSync(object):
         if verbose and loglevel != 10:
             loglevel -= 10
 
-        logger = logging.getLogger()
+        # every job has its own logger with its own level and handlers, so jobs in one process
+        #   don't write to each other's log files. It isn't registered with logging.getLogger(),
+        #   so it's freed with the job
+        logger = logging.Logger('causync')
         logger.setLevel(loglevel)
         formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
 
         # logfile handler
-        lf_handler = logging.FileHandler(logfile)
+        lf_handler = logging.FileHandler(os.path.abspath(logfile), delay=True)
         lf_handler.setFormatter(formatter)
         logger.addHandler(lf_handler)
 
@@ -440,6 +2791,80 @@ class CauSync(object):
                 raise e
         return True
 
+    @staticmethod
+    def get_fstype(path):
+        """ Returns the filesystem type of path (from /proc/mounts), or None if it's unknown. """
+
+        path = os.path.realpath(path)
+        (mountpoint, fstype) = ('', None)
+
+        try:
+            with open('/proc/mounts', 'r') as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) < 3:
+                        continue
+                    # spaces are escaped as \040 in /proc/mounts
+                    mp = fields[1].replace('\\040', ' ')
+                    if (path == mp or path.startswith(mp.rstrip('/') + '/')) and len(mp) >= len(mountpoint):
+                        (mountpoint, fstype) = (mp, fields[2])
+        except IOError:
+            return None
+
+        return fstype
+
+    @staticmethod
+    def is_same_inode(st, path):
+        """ Returns True if path is a hard link to the inode of the stat result st. """
+        try:
+            other = os.lstat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+        return (other.st_dev, other.st_ino) == (st.st_dev, st.st_ino)
+
+    @staticmethod
+    def hash_file(path, chunk_size=1024 * 1024):
+        """ Returns the sha256 hex digest of a file, reading it in chunks. """
+
+        import hashlib
+
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    @staticmethod
+    def parse_size(value):
+        """ Converts a number printed by rsync to int.
+            Example: '1,234' results in 1234, '1.23K' (--human-readable) results in 1230, '0.5' in 0.5.
+        """
+        units = {'K': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9, 'T': 10 ** 12, 'P': 10 ** 15}
+        value = value.replace(',', '')
+        if value and value[-1] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+        number = float(value)
+        # times (seconds) aren't integers
+        return int(number) if number.is_integer() else number
+
+    @staticmethod
+    def parse_rsync_stats(output):
+        """ Returns the numeric fields of rsync's --stats output as a dict, repeated fields are summed.
+            Example: 'Total transferred file size: 1.23K bytes' results in {'Total transferred file size': 1230}.
+        """
+        stats = dict()
+        for line in output.splitlines():
+            (key, sep, value) = line.partition(': ')
+            if not sep or not value:
+                continue
+            try:
+                number = CauSync.parse_size(value.split()[0])
+            except ValueError:
+                continue
+            # sharded syncs print one block per rsync call
+            stats[key.strip()] = stats.get(key.strip(), 0) + number
+        return stats
+
     @staticmethod
     def parse_exclude_file(fname):
         """ Read exclude file and return a list of paths """
@@ -458,17 +2883,21 @@ def parse_args():
     """ Parses command-line arguments and
         sets a few variables depending on the 'task' argument.
     """
+
+    from argparse import ArgumentParser
+
     parser = ArgumentParser(description="Causality backup solution")
 
-    parser.add_argument('task', choices=['check', 'sync', 'cleanup'], help='task to execute')
+    parser.add_argument('task', choices=['check', 'sync', 'cleanup', 'cleanup-all', 'verify', 'diff', 'rebase', 'report',
+                                         'pack', 'restore', 'send', 'receive'], help='task to execute')
 
     parser.add_argument('sources',
                         metavar='sources',
                         type=str,
-                        nargs='+',
-                        help='sync source directory')
+                        nargs='*',
+                        help='sync source directory (first backup for diff)')
 
-    parser.add_argument('destination', help='sync destination directory')
+    parser.add_argument('destination', help='sync destination directory (root directory for cleanup-all, second backup for diff)')
 
     parser.add_argument('--no-incremental',
                         dest='no_incremental',
@@ -527,7 +2956,84 @@ def parse_args():
                         default=False,
                         help='cleanup after sync')
 
-    arguments = parser.parse_args()
+    parser.add_argument('--overlap-cleanup',
+                        dest='overlap_cleanup',
+                        action='store_true',
+                        default=False,
+                        help='sync: delete expired backups while rsync runs (implies --cleanup)')
+
+    parser.add_argument('--shards',
+                        action='store_true',
+                        default=False,
+                        help='sync: run one rsync per top-level source directory, resume failed syncs')
+
+    parser.add_argument('--shard-file',
+                        dest='shard_file',
+                        default=None,
+                        help='sync: read shards (tab separated top-level directory names per line) from a FILE')
+
+    parser.add_argument('--progress',
+                        action='store_true',
+                        default=False,
+                        help='sync: estimate the size of the sources, write progress and ETA to the status file')
+
+    parser.add_argument('--estimate',
+                        action='store_true',
+                        default=False,
+                        help='check: print the estimated size of the sources and the expected duration as JSON')
+
+    parser.add_argument('--status',
+                        action='store_true',
+                        default=False,
+                        help='check: print a one-line JSON status from the pidfile and exit')
+
+    parser.add_argument('--plan',
+                        action='store_true',
+                        default=False,
+                        help='cleanup: print a JSON cleanup plan to stdout, don\'t delete anything')
+
+    parser.add_argument('--apply',
+                        action='store',
+                        default=None,
+                        metavar='PLAN',
+                        help='cleanup: delete exactly what the JSON cleanup PLAN file lists')
+
+    parser.add_argument('--snapshot',
+                        action='store',
+                        default=None,
+                        help='restore, send: backup directory name to restore from or to send')
+
+    parser.add_argument('--member',
+                        action='store',
+                        default=None,
+                        metavar='PATH',
+                        help='restore: path of the file to restore, relative to the backup directory')
+
+    parser.add_argument('--base',
+                        action='store',
+                        default=None,
+                        help='send: backup directory name the receiver already has (default: send everything)')
+
+    parser.add_argument('-o',
+                        '--output',
+                        action='store',
+                        default=None,
+                        help='restore, send: file to restore to or to write the stream to (default: stdout)')
+
+    arguments = parser.parse_intermixed_args()
+
+    if arguments.task in NO_SOURCE_TASKS:
+        if arguments.sources:
+            parser.error("{} doesn't take source directories".format(arguments.task))
+    elif not arguments.sources:
+        parser.error("the following arguments are required: sources")
+    elif arguments.task in SINGLE_SOURCE_TASKS and len(arguments.sources) != 1:
+        parser.error("{} takes exactly one source directory".format(arguments.task))
+
+    if arguments.task == 'restore' and not (arguments.snapshot and arguments.member):
+        parser.error("restore needs --snapshot and --member")
+    if arguments.task == 'send' and not arguments.snapshot:
+        parser.error("send needs --snapshot")
 
     arguments.selfname = sys.argv[0]
 
@@ -535,21 +3041,40 @@ def parse_args():
 
 
 if __name__ == "__main__":
+    # fast path for monitoring, it doesn't parse arguments, set up logging or fork
+    if sys.argv[1:2] == ['check'] and '--status' in sys.argv:
+        print(check_status(get_pidfile_arg(sys.argv, conf.PIDFILE)))
+        sys.exit(0)
+
     args = parse_args()
 
-    cs = CauSync(conf,
-                 args.sources,
-                 args.destination,
-                 args.task,
-                 args.no_incremental,
-                 args.quiet,
-                 args.dry_run,
-                 args.selfname,
-                 args.excludes,
-                 args.exclude_from,
-                 args.loglevel,
-                 args.verbose,
-                 args.pidfile,
-                 args.cleanup,
-                 args.logfile)
-    cs.run()
+    try:
+        cs = CauSync(conf,
+                     args.sources,
+                     args.destination,
+                     args.task,
+                     args.no_incremental,
+                     args.quiet,
+                     args.dry_run,
+                     args.selfname,
+                     args.excludes,
+                     args.exclude_from,
+                     args.loglevel,
+                     args.verbose,
+                     args.pidfile,
+                     args.cleanup,
+                     args.logfile,
+                     args.plan,
+                     args.apply,
+                     args.shards,
+                     args.shard_file,
+                     args.overlap_cleanup,
+                     args.snapshot,
+                     args.member,
+                     args.output,
+                     args.progress,
+                     args.estimate,
+                     args.base)
+        cs.run()
+    except CauSyncError:
+        sys.exit(-1)
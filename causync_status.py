@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Status reader of causync jobs, for monitoring.
+
+    Python compiles the script it runs on every start, only imported modules have cached bytecode,
+    so polling 'causync.py check --status' compiles all of causync.py each time.
+    This module is small and causync.py imports it, so both are cheap.
+    Usage: python3 causync_status.py [-p PIDFILE]
+"""
+
+import os
+import sys
+
+
+def get_statusfile(pidfile):
+    """ Returns the path of the status file which belongs to pidfile. """
+    return "{}.status".format(pidfile)
+
+
+def check_status(pidfile):
+    """ Returns a one-line JSON status for 'check --status'.
+        It only reads the pidfile and the status file, it doesn't fork and it doesn't
+        import anything heavy, so it's cheap enough to be polled by monitoring.
+    """
+
+    try:
+        with open(pidfile, 'r') as f:
+            pid = int(f.read().strip())
+    except (IOError, ValueError):
+        return '{"running": false}'
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return '{{"running": false, "stale_pid": {}}}'.format(pid)
+    except PermissionError:
+        # the process exists, but it belongs to another user
+        pass
+
+    try:
+        with open(get_statusfile(pidfile), 'r') as f:
+            status = f.readline().strip()
+    except IOError:
+        status = None
+
+    return status if status else '{{"running": true, "pid": {}}}'.format(pid)
+
+
+def get_pidfile_arg(argv, default):
+    """ Returns the -p/--pidfile argument from argv without using argparse. """
+    for (i, arg) in enumerate(argv):
+        if arg in ('-p', '--pidfile') and i + 1 < len(argv):
+            return argv[i + 1]
+        if arg.startswith('--pidfile='):
+            return arg[len('--pidfile='):]
+    return default
+
+
+if __name__ == "__main__":
+    import config
+
+    print(check_status(get_pidfile_arg(sys.argv, config.PIDFILE)))
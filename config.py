@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 # config file for causync
 
+import os
+
 LOGFILE = "causync.log"
 PIDFILE = "/tmp/causync.pid"
 
@@ -32,4 +34,69 @@ RSYNC_FLAGS = (
 DATE_FORMAT = "%Y%m%d"
 
 # use pgrep to determine whether CS is running with the same arguments
-CHECK_PGREP = True
\ No newline at end of file
+CHECK_PGREP = True
+
+# cleanup-all: how deep to look for destinations under the root directory
+DISCOVER_MAX_DEPTH = 3
+# cleanup-all: number of threads, and max destinations cleaned up in parallel per device
+CLEANUP_WORKERS = 8
+CLEANUP_DEVICE_CONCURRENCY = 2
+
+# sync --cleanup: delete expired backups in a low priority thread while rsync runs (same as --overlap-cleanup).
+#   Deletions wait up to CLEANUP_OVERLAP_DELAY seconds between backups, less as the free space of the
+#   destination drops towards CLEANUP_MIN_FREE (part of the filesystem), and don't wait at all below it.
+CLEANUP_OVERLAP = False
+CLEANUP_OVERLAP_DELAY = 30
+CLEANUP_MIN_FREE = 0.1
+
+# verify: hash store (inside the destination directory), hashing threads and read size
+VERIFY_HASHFILE = ".causync_hashes.json"
+VERIFY_WORKERS = os.cpu_count() or 4
+VERIFY_CHUNK_SIZE = 1024 * 1024
+
+# diff: number of directory scanning threads
+DIFF_WORKERS = 8
+
+# rebase: hard link limit (None: ask the filesystem) and the part of it
+#   above which files of the latest backup are replaced with fresh copies
+LINK_MAX = None
+LINK_REBASE_RATIO = 0.9
+
+# run history of each destination (JSON lines, inside the destination directory)
+HISTORY_FILE = ".causync_history.jsonl"
+# report: compare the last REPORT_RECENT_DAYS with the REPORT_BASELINE_DAYS before,
+#   changes by REPORT_REGRESSION_RATIO or more are regressions
+REPORT_RECENT_DAYS = 7
+REPORT_BASELINE_DAYS = 28
+REPORT_REGRESSION_RATIO = 2.0
+
+# sync each top-level source directory with a separate rsync call (same as --shards),
+#   completed shards are recorded in CHECKPOINT_FILE (inside the destination directory)
+SYNC_SHARDS = False
+CHECKPOINT_FILE = ".causync_checkpoint.json"
+
+# sync: estimate the size of the sources and write the progress and ETA to the status file (same as --progress),
+#   uses rsync --info=progress2 (rsync 3.1+). Estimates are cached in SCAN_CACHE_FILE (inside the destination directory)
+#   and refreshed from the stats of each sync, the sources are scanned with SCAN_WORKERS threads
+#   when the cached estimate is older than SCAN_CACHE_DAYS days.
+SYNC_PROGRESS = False
+SCAN_WORKERS = 8
+SCAN_CACHE_FILE = ".causync_scan.json"
+SCAN_CACHE_DAYS = 7
+
+# how backups are created: 'hardlink' (rsync --link-dest), 'btrfs' (subvolume snapshots),
+#   'reflink' (copy-on-write copies) or 'auto' (btrfs or reflink if supported, hardlink otherwise)
+#   diff and rebase need the hardlink backend, verify and dedup hash every file on the others
+SNAPSHOT_BACKEND = 'hardlink'
+
+# filesystems which may support copy-on-write copies, 'auto' only looks for a CoW backend on these
+COW_FILESYSTEMS = ('btrfs', 'xfs', 'ocfs2', 'bcachefs', 'zfs')
+
+# pack: backups older than this many days are packed into one indexed archive each
+PACK_AFTER_DAYS = 365
+
+# shared content store for deduplication across destinations (None: disabled),
+#   it has to be on the same filesystem as the destinations. Files smaller than
+#   DEDUP_MIN_SIZE bytes are left alone.
+DEDUP_POOL = None
+DEDUP_MIN_SIZE = 1024
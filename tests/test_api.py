@@ -0,0 +1,162 @@
+import logging
+import threading
+
+from nose.tools import *
+
+from causync import CauSync, CauSyncError, Settings, CleanupResult, SyncResult
+import config
+
+from tests.testhelper import *
+
+
+def test_settings():
+    settings = Settings(config, DATE_FORMAT="%Y%m%d_%H%M")
+
+    assert_equals(settings.DATE_FORMAT, "%Y%m%d_%H%M")
+    assert_equals(settings.BACKUPS_TO_KEEP['daily'], config.BACKUPS_TO_KEEP['daily'])
+    assert_raises(AttributeError, setattr, settings, 'DATE_FORMAT', "%Y")
+
+    def set_daily():
+        settings.BACKUPS_TO_KEEP['daily'] = 1
+    assert_raises(TypeError, set_daily)
+
+    other = settings.replace(BACKUPS_LINK_DEST_COUNT=1)
+    assert_equals(other.BACKUPS_LINK_DEST_COUNT, 1)
+    assert_equals(other.DATE_FORMAT, "%Y%m%d_%H%M")
+    assert_equals(settings.BACKUPS_LINK_DEST_COUNT, config.BACKUPS_LINK_DEST_COUNT)
+
+
+def test_config_module_unchanged():
+    create_temp()
+
+    (pidfile, logfile) = (config.PIDFILE, config.LOGFILE)
+    cs = CauSync(config, src, dst, task='sync', pidfile='./temp/job.pid', logfile='./temp/job.log')
+
+    assert_equals(cs.config.PIDFILE, './temp/job.pid')
+    assert_equals((config.PIDFILE, config.LOGFILE), (pidfile, logfile))
+
+    remove_temp()
+
+
+def test_parallel_cleanup():
+    create_temp()
+
+    # two jobs with different retention settings, running in threads
+    jobs = dict()
+    for (name, daily) in (('site1', 7), ('site2', 1)):
+        d = os.path.join('./temp/backups', name)
+        [os.makedirs(os.path.join(d, i)) for i in dirnames]
+        jobs[name] = CauSync(Settings(config, BACKUPS_TO_KEEP={'yearly': 10, 'monthly': 6, 'weekly': 4,
+                                                               'daily': daily}),
+                             src, d, task='cleanup')
+
+    results = dict()
+    threads = [threading.Thread(target=lambda n=n: results.update({n: jobs[n].cleanup(curdate=datetime(2018, 4, 11))}))
+               for n in jobs]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+
+    assert_true(isinstance(results['site1'], CleanupResult))
+    assert_equals(sorted(results['site1'].kept), sorted(dirnames_keep))
+    # site2 only keeps two days of daily backups
+    assert_false('20180408' in results['site2'].kept)
+    assert_true('20180408' in results['site2'].deleted)
+    assert_true(os.path.isdir(os.path.join('./temp/backups', 'site1', '20180408')))
+    assert_false(os.path.isdir(os.path.join('./temp/backups', 'site2', '20180408')))
+
+    remove_temp()
+
+
+def test_destination_busy():
+    create_temp()
+    os.makedirs(dst)
+
+    cs = CauSync(config, src, dst, task='cleanup')
+    other = CauSync(config, src, dst, task='cleanup')
+
+    lock = cs.lock_destination()
+    errors = list()
+
+    def cleanup():
+        try:
+            other.cleanup()
+        except CauSyncError as e:
+            errors.append(e)
+
+    t = threading.Thread(target=cleanup)
+    t.start()
+    t.join()
+    lock.release()
+
+    assert_equals(len(errors), 1)
+
+    remove_temp()
+
+
+def test_sync_result():
+    create_temp()
+
+    cs = CauSync(Settings(config, DATE_FORMAT=date_format), src, dst, task='sync')
+    result = cs.sync()
+
+    assert_true(isinstance(result, SyncResult))
+    assert_equals(result.snapshot, os.path.join(os.path.realpath(dst), curdate_str))
+    assert_true(os.path.isfile(os.path.join(result.snapshot, 'causync_src', 'testdir1', 'testfile1')))
+    assert_equals(result.cleanup, None)
+    assert_equals(len(cs.load_history()), 1)
+
+    remove_temp()
+
+
+def test_job_loggers():
+    create_temp()
+
+    quiet = CauSync(config, src, dst, task='check', quiet=True, logfile='./temp/a.log', loglevel='error')
+    chatty = CauSync(config, src, dst, task='check', quiet=True, logfile='./temp/b.log', loglevel='debug')
+
+    quiet.logger.info("quiet info")
+    quiet.logger.error("quiet error")
+    chatty.logger.info("chatty info")
+    [cs.close() for cs in (quiet, chatty)]
+
+    with open('./temp/a.log') as f:
+        a = f.read()
+    with open('./temp/b.log') as f:
+        b = f.read()
+
+    assert_true("quiet error" in a)
+    assert_false("quiet info" in a)
+    assert_false("chatty" in a)
+    assert_true("chatty info" in b)
+    assert_false("quiet" in b)
+
+    remove_temp()
+
+
+def test_job_resources():
+    create_temp()
+    os.makedirs(dst)
+
+    def open_fds():
+        return len(os.listdir('/proc/self/fd'))
+
+    loggers = len(logging.Logger.manager.loggerDict)
+    fds = open_fds()
+
+    # many jobs in one long-lived process don't keep log files or loggers around
+    for i in range(50):
+        cs = CauSync(config, src, dst, task='cleanup', quiet=True)
+        cs.cleanup(curdate=datetime(2018, 4, 11))
+    assert_equals(open_fds(), fds)
+    assert_equals(len(logging.Logger.manager.loggerDict), loggers)
+
+    # a closed job can still log, and 'with' closes it
+    with CauSync(config, src, dst, task='cleanup', quiet=True, logfile='./temp/c.log') as cs:
+        cs.logger.error("first")
+        cs.close()
+        cs.logger.error("second")
+    assert_equals(open_fds(), fds)
+    with open('./temp/c.log') as f:
+        assert_equals([line.split()[-1] for line in f], ["first", "second"])
+
+    remove_temp()
@@ -0,0 +1,86 @@
+from unittest import SkipTest
+
+from nose.tools import *
+
+from causync import CauSync, CauSyncError
+import config
+
+from tests.testhelper import *
+
+# set this to a directory on a btrfs filesystem to run the btrfs tests, for example a loopback image:
+#   truncate -s 256M /tmp/btrfs.img && mkfs.btrfs /tmp/btrfs.img
+#   mount -o loop /tmp/btrfs.img /mnt/btrfs && CAUSYNC_BTRFS_DIR=/mnt/btrfs nosetests test_backends.py
+btrfs_dir = os.environ.get('CAUSYNC_BTRFS_DIR')
+
+
+def test_get_fstype():
+    assert_true(CauSync.get_fstype('/'))
+    assert_equals(CauSync.get_fstype('/proc/self'), 'proc')
+
+
+def test_hardlink_backend():
+    create_temp()
+    os.makedirs(dst)
+
+    cs = CauSync(config, src, dst, task='sync')
+    cs.config = cs.config.replace(SNAPSHOT_BACKEND='hardlink')
+    assert_equals(cs.get_backend(), 'hardlink')
+
+    remove_temp()
+
+
+def test_btrfs_backend():
+    if not btrfs_dir:
+        raise SkipTest("CAUSYNC_BTRFS_DIR is not set")
+
+    root = os.path.join(btrfs_dir, 'causync_test')
+    rmtree(root) if os.path.isdir(root) else False
+    os.makedirs(root)
+
+    cs = CauSync(config, src, root, task='sync')
+    cs.config = cs.config.replace(DATE_FORMAT=date_format)
+    assert_equals(cs.get_backend(), 'btrfs')
+
+    (first, second) = (os.path.join(root, '20180410'), os.path.join(root, '20180411'))
+    cs.create_snapshot('btrfs', first)
+    with open(os.path.join(first, 'testfile'), 'w') as fp:
+        fp.write(lorem)
+
+    # the second backup is a snapshot of the first one
+    cs.create_snapshot('btrfs', second)
+    assert_true(cs.is_subvolume(first))
+    assert_true(cs.is_subvolume(second))
+    with open(os.path.join(second, 'testfile'), 'r') as fp:
+        assert_equals(fp.read(), lorem)
+
+    cs.rmtree(['20180410', '20180411'], root)
+    assert_false(os.path.exists(first))
+    assert_false(os.path.exists(second))
+
+    rmtree(root)
+
+
+def test_auto_backend_dry_run():
+    create_temp()
+    os.makedirs(dst)
+
+    cs = CauSync(config, src, dst, task='sync', dry_run=True)
+    cs.config = cs.config.replace(SNAPSHOT_BACKEND='auto', COW_FILESYSTEMS=(CauSync.get_fstype(dst),))
+    mtime = os.stat(dst).st_mtime_ns
+    assert_in(cs.get_backend(), ('hardlink', 'btrfs'))
+    # the reflink probe didn't create and remove anything in the destination
+    assert_equals(os.stat(dst).st_mtime_ns, mtime)
+
+    remove_temp()
+
+
+def test_diff_cow_backend():
+    create_temp()
+    for name in ('20180410', '20180411'):
+        os.makedirs(os.path.join(dst, name))
+
+    cs = CauSync(config, os.path.join(dst, '20180410'), os.path.join(dst, '20180411'), task='diff')
+    cs.config = cs.config.replace(SNAPSHOT_BACKEND='reflink')
+    assert_raises(CauSyncError, cs.run_diff)
+
+    remove_temp()
@@ -1,4 +1,6 @@
 from nose.tools import *
+import json
+import subprocess
 
 from causync import CauSync
 import config
@@ -13,12 +15,12 @@ def test_cleanup():
     remove_temp()
 
     cs = CauSync(config, src, dst, task='cleanup')
-    cs.config.DATE_FORMAT = "%Y%m%d"
-    cs.config.BACKUPS_TO_KEEP = {'yearly': 10, 'monthly': 6,
-                                 'weekly': 4, 'daily': 7}
-    cs.config.BACKUP_MULTIPLIERS = {'yearly': 365, 'monthly': 31,
-                                    'weekly': 7, 'daily': 1}
-    cs.config.BACKUPS_LINK_DEST_COUNT = 5
+    cs.config = cs.config.replace(DATE_FORMAT="%Y%m%d",
+                                  BACKUPS_TO_KEEP={'yearly': 10, 'monthly': 6,
+                                                   'weekly': 4, 'daily': 7},
+                                  BACKUP_MULTIPLIERS={'yearly': 365, 'monthly': 31,
+                                                      'weekly': 7, 'daily': 1},
+                                  BACKUPS_LINK_DEST_COUNT=5)
     cs.curdate = curdate
 
     create_temp()
@@ -40,3 +42,214 @@ def test_cleanup():
         assert_false(os.path.isdir(isdircheck))
 
     remove_temp()
+
+
+def test_cleanup_plan():
+    remove_temp()
+
+    cs = CauSync(config, src, dst, task='cleanup', plan=True)
+    cs.config = cs.config.replace(DATE_FORMAT="%Y%m%d",
+                                  BACKUPS_TO_KEEP={'yearly': 10, 'monthly': 6,
+                                                   'weekly': 4, 'daily': 7},
+                                  BACKUP_MULTIPLIERS={'yearly': 365, 'monthly': 31,
+                                                      'weekly': 7, 'daily': 1})
+    cs.curdate = curdate
+
+    create_temp()
+
+    os.makedirs(dst)
+    [ os.makedirs(os.path.join(dst, i)) for i in dirnames ]
+
+    # 20040101 holds a unique file, 20050101 shares one with a kept backup
+    with open(os.path.join(dst, '20040101', 'unique'), 'w') as fp:
+        fp.write(lorem)
+    with open(os.path.join(dst, '20180411', 'shared'), 'w') as fp:
+        fp.write(lorem)
+    os.link(os.path.join(dst, '20180411', 'shared'), os.path.join(dst, '20050101', 'shared'))
+
+    plan = cs.plan_cleanup()
+
+    dirnames_delete = list(set(dirnames) - set(dirnames_keep))
+
+    assert_equals(sorted(i['name'] for i in plan['keep']), sorted(dirnames_keep))
+    assert_equals(sorted(i['name'] for i in plan['delete']), sorted(dirnames_delete))
+
+    reasons = dict((i['name'], i['reason']) for i in plan['keep'] + plan['delete'])
+    assert_equals(reasons['20180101'], 'yearly')
+    assert_equals(reasons['20171101'], 'monthly')
+    assert_equals(reasons['20180402'], 'weekly')
+    assert_equals(reasons['20180411'], 'daily')
+    assert_equals(reasons['20040101'], 'yearly')
+
+    unique_size = os.lstat(os.path.join(dst, '20040101', 'unique')).st_blocks * 512
+    assert_true(plan['bytes_freed'] >= unique_size)
+
+    # planning doesn't delete anything
+    for dirname in dirnames:
+        assert_true(os.path.isdir(os.path.join(dst, dirname)))
+
+    remove_temp()
+
+
+def test_cleanup_apply():
+    remove_temp()
+    create_temp()
+
+    os.makedirs(dst)
+    [ os.makedirs(os.path.join(dst, i)) for i in dirnames ]
+
+    plan_file = './temp/plan.json'
+    plan = {'destination': os.path.realpath(dst),
+            'delete': [{'name': '20180402', 'reason': 'daily'},
+                       {'name': '20040101', 'reason': 'yearly'},
+                       {'name': '../causync_src', 'reason': 'daily'},
+                       {'name': 'important_data', 'reason': 'daily'},
+                       {'name': 'notes.txt', 'reason': 'daily'},
+                       {'name': '20180101', 'reason': 'daily'}]}
+    # a directory and a file which aren't backups, and a backup which is already gone
+    os.makedirs(os.path.join(dst, 'important_data'))
+    with open(os.path.join(dst, 'notes.txt'), 'w') as fp:
+        fp.write(lorem)
+    os.rmdir(os.path.join(dst, '20180101'))
+    with open(plan_file, 'w') as fp:
+        json.dump(plan, fp)
+
+    cs = CauSync(config, src, dst, task='cleanup', apply=plan_file)
+    cs.config = cs.config.replace(DATE_FORMAT="%Y%m%d")
+    cs.apply_cleanup_plan(cs.load_cleanup_plan(plan_file))
+
+    assert_false(os.path.isdir(os.path.join(dst, '20180402')))
+    assert_false(os.path.isdir(os.path.join(dst, '20040101')))
+    # only the plan's entries are removed, nothing outside the destination
+    assert_true(os.path.isdir(src))
+    assert_true(os.path.isdir(os.path.join(dst, 'important_data')))
+    assert_true(os.path.isfile(os.path.join(dst, 'notes.txt')))
+    for dirname in set(dirnames) - set(['20180402', '20040101', '20180101']):
+        assert_true(os.path.isdir(os.path.join(dst, dirname)))
+
+    remove_temp()
+
+
+def test_cleanup_all():
+    remove_temp()
+    create_temp()
+
+    root = './temp/backups'
+    destinations = [os.path.join(root, 'site1'), os.path.join(root, 'group', 'site2')]
+    for d in destinations:
+        [ os.makedirs(os.path.join(d, i)) for i in dirnames ]
+    # not a destination, no backup directories inside
+    os.makedirs(os.path.join(root, 'group', 'notes', 'misc'))
+
+    cs = CauSync(config, [], root, task='cleanup-all')
+    cs.config = cs.config.replace(DATE_FORMAT="%Y%m%d",
+                                  BACKUPS_TO_KEEP={'yearly': 10, 'monthly': 6,
+                                                   'weekly': 4, 'daily': 7},
+                                  BACKUP_MULTIPLIERS={'yearly': 365, 'monthly': 31,
+                                                      'weekly': 7, 'daily': 1})
+    cs.curdate = curdate
+
+    assert_equals(cs.find_destinations(cs.dst_abs),
+                  sorted(os.path.realpath(d) for d in destinations))
+
+    results = cs.run_cleanup_all()
+
+    dirnames_delete = list(set(dirnames) - set(dirnames_keep))
+    assert_equals(len(results), 2)
+    for r in results:
+        assert_equals(r['deleted'], len(dirnames_delete))
+        assert_equals(r['kept'], len(dirnames_keep))
+        assert_equals(r['failed'], 0)
+
+    for d in destinations:
+        for dirname in dirnames_keep:
+            assert_true(os.path.isdir(os.path.join(d, dirname)))
+        for dirname in dirnames_delete:
+            assert_false(os.path.isdir(os.path.join(d, dirname)))
+
+    remove_temp()
+
+
+def test_cleanup_all_failures():
+    create_temp()
+
+    root = './temp/backups'
+    (site1, site2) = (os.path.join(root, 'site1'), os.path.join(root, 'site2'))
+    [os.makedirs(os.path.join(site1, i)) for i in dirnames]
+    # nothing to delete in site2
+    [os.makedirs(os.path.join(site2, i)) for i in dirnames_keep]
+
+    cs = CauSync(config, [], root, task='cleanup-all', quiet=True, logfile='./temp/cleanup.log')
+    cs.config = cs.config.replace(DATE_FORMAT="%Y%m%d",
+                                  BACKUPS_TO_KEEP={'yearly': 10, 'monthly': 6,
+                                                   'weekly': 4, 'daily': 7},
+                                  BACKUP_MULTIPLIERS={'yearly': 365, 'monthly': 31,
+                                                      'weekly': 7, 'daily': 1})
+    cs.curdate = curdate
+
+    # a failing 'btrfs subvolume delete' only fails one backup
+    remove_backup_dir = cs.remove_backup_dir
+
+    def fail_once(path):
+        if path.endswith('20040101'):
+            raise subprocess.CalledProcessError(1, 'btrfs subvolume delete')
+        remove_backup_dir(path)
+    cs.remove_backup_dir = fail_once
+
+    results = dict((os.path.basename(r['destination']), r) for r in cs.run_cleanup_all())
+    dirnames_delete = set(dirnames) - set(dirnames_keep)
+    assert_equals((results['site1']['deleted'], results['site1']['failed']), (len(dirnames_delete) - 1, 1))
+    assert_equals((results['site2']['deleted'], results['site2']['failed']), (0, 0))
+    assert_true(os.path.isdir(os.path.join(site1, '20040101')))
+
+    # every destination logs its totals
+    with open('./temp/cleanup.log') as fp:
+        log = fp.read()
+    assert_true("site2: deleted 0 backups (0 failed)" in log)
+    assert_true("site1: deleted {} backups (1 failed)".format(len(dirnames_delete) - 1) in log)
+
+    remove_temp()
+
+
+def test_overlapped_cleanup():
+    create_temp()
+
+    os.makedirs(dst)
+    [os.makedirs(os.path.join(dst, i)) for i in dirnames]
+
+    cs = CauSync(config, src, dst, task='sync', overlap_cleanup=True)
+    cs.config = cs.config.replace(DATE_FORMAT="%Y%m%d",
+                                  BACKUPS_TO_KEEP={'yearly': 10, 'monthly': 6,
+                                                   'weekly': 4, 'daily': 1},
+                                  BACKUPS_LINK_DEST_COUNT=5,
+                                  CLEANUP_OVERLAP_DELAY=0)
+    cs.curdate = curdate
+
+    assert_true(cs.cleanup_after_sync)
+    expired = cs.get_plan_dirnames(cs.plan_cleanup(estimate=False))
+    # with one daily backup kept, the latest five would be deleted, but rsync reads them
+    assert_true('20180407' in expired)
+
+    (thread, stop, deleted) = cs.start_overlapped_cleanup()
+    thread.join()
+    deleted = cs.stop_overlapped_cleanup((thread, stop, deleted))
+
+    assert_equals(deleted, sorted(set(expired) - {'20180407', '20180408', '20180409', '20180410', '20180411'}))
+    for dirname in dirnames:
+        assert_equals(os.path.isdir(os.path.join(dst, dirname)), dirname not in deleted)
+
+    remove_temp()
+
+
+def test_cleanup_delay():
+    create_temp()
+
+    cs = CauSync(config, src, './temp', task='sync')
+    cs.config = cs.config.replace(CLEANUP_OVERLAP_DELAY=10, CLEANUP_MIN_FREE=0)
+    assert_equals(cs.get_cleanup_delay(), 10)
+
+    # the filesystem is always less than 100% free, so it's below the minimum
+    cs.config = cs.config.replace(CLEANUP_MIN_FREE=1.0)
+    assert_equals(cs.get_cleanup_delay(), 0)
+
+    remove_temp()
@@ -7,7 +7,7 @@ import config
 def test_get_dirdate():
     cs = CauSync(config, "/tmp/causync_src", "/tmp/causync_dest", 'check')
     now = datetime.now()
-    cs.config.DATE_FORMAT = "%Y%m%d"
+    cs.config = cs.config.replace(DATE_FORMAT="%Y%m%d")
     dirname = now.strftime(config.DATE_FORMAT)
 
     assert isinstance(cs.get_dirdate(dirname), datetime)
@@ -0,0 +1,44 @@
+from nose.tools import *
+
+from causync import CauSync, Settings
+import config
+
+from tests.testhelper import *
+
+
+def test_dedup():
+    create_temp()
+
+    pool = os.path.realpath('./temp/pool')
+    (dst1, dst2) = ('./temp/causync_dst1', './temp/causync_dst2')
+    # two destinations with identical copies of the source
+    for d in [dst1, dst2]:
+        shutil.copytree(src, os.path.join(d, '20180411', 'causync_src'))
+
+    settings = Settings(config, DATE_FORMAT=date_format, DEDUP_POOL=pool, DEDUP_MIN_SIZE=0)
+    cs1 = CauSync(settings, src, dst1, task='sync')
+    cs2 = CauSync(settings, src, dst2, task='sync')
+
+    # the first destination fills the content store, the second one is linked to it
+    assert_equals(cs1.run_dedup(), (0, 3, 0))
+    (deduplicated, added, saved) = cs2.run_dedup()
+    assert_equals((deduplicated, added), (3, 0))
+
+    testfile = os.path.join('20180411', 'causync_src', 'testdir1', 'testfile1')
+    st1 = os.lstat(os.path.join(dst1, testfile))
+    st2 = os.lstat(os.path.join(dst2, testfile))
+    assert_equals(st1.st_ino, st2.st_ino)
+    assert_equals(st1.st_nlink, 3)
+    with open(os.path.join(dst2, testfile), 'r') as fp:
+        assert_equals(fp.read(), lorem[lorem_parts[0][0]: lorem_parts[0][1]])
+
+    # nothing new to deduplicate
+    assert_equals(cs2.run_dedup(), (0, 0, 0))
+
+    # entries are kept while a backup links to them
+    cs1.rmtree(['20180411'])
+    assert_equals(cs1.gc_pool()[0], 0)
+    cs2.rmtree(['20180411'])
+    assert_equals(cs2.gc_pool()[0], 3)
+
+    remove_temp()
@@ -0,0 +1,59 @@
+from io import StringIO
+
+from nose.tools import *
+
+from causync import CauSync, CauSyncError
+import config
+
+from tests.testhelper import *
+
+
+def test_diff():
+    create_temp()
+
+    (a, b) = (os.path.join(dst, '20180410'), os.path.join(dst, '20180411'))
+    shutil.copytree(src, a)
+    os.makedirs(os.path.join(b, 'testdir1'))
+    os.makedirs(os.path.join(b, 'testdir3', 'sub'))
+
+    # unchanged (hard link), modified (new inode), removed (testdir2), added (testdir3)
+    os.link(os.path.join(a, 'testdir1', 'testfile1'), os.path.join(b, 'testdir1', 'testfile1'))
+    with open(os.path.join(b, 'testdir1', 'testfile2'), 'w') as fp:
+        fp.write(lorem)
+    with open(os.path.join(b, 'testdir3', 'sub', 'testfile4'), 'w') as fp:
+        fp.write('test')
+
+    cs = CauSync(config, a, b, task='diff')
+    out = StringIO()
+    totals = cs.run_diff(out)
+
+    lines = sorted(out.getvalue().splitlines())
+    assert_equals(lines, sorted([
+        "M {} {}".format(len(lorem), os.path.join('testdir1', 'testfile2')),
+        "- {} {}".format(lorem_parts[2][1] - lorem_parts[2][0], os.path.join('testdir2', 'testfile3')),
+        "+ 4 {}".format(os.path.join('testdir3', 'sub', 'testfile4'))]))
+
+    assert_equals(totals['added'], [1, 4])
+    assert_equals(totals['removed'], [1, lorem_parts[2][1] - lorem_parts[2][0]])
+    assert_equals(totals['modified'], [1, len(lorem)])
+
+    remove_temp()
+
+
+def test_diff_missing():
+    create_temp()
+
+    a = os.path.join(dst, '20180410')
+    shutil.copytree(src, a)
+    with open(os.path.join(dst, '20180409.pack'), 'w') as fp:
+        fp.write('')
+
+    # a mistyped or packed backup isn't an empty one
+    for b in (os.path.join(dst, '20180411'), os.path.join(dst, '20180409')):
+        for (x, y) in ((a, b), (b, a)):
+            cs = CauSync(config, x, y, task='diff')
+            out = StringIO()
+            assert_raises(CauSyncError, cs.run_diff, out)
+            assert_equals(out.getvalue(), '')
+
+    remove_temp()
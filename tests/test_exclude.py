@@ -10,7 +10,7 @@ def test_exclude():
 
     # start sync testing
     cs = CauSync(config, src, dst, task='sync', excludes=['testfile2'])
-    cs.config.DATE_FORMAT = date_format
+    cs.config = cs.config.replace(DATE_FORMAT=date_format)
     cs.run_sync()
 
     # collect destination testfile paths
@@ -30,7 +30,7 @@ def test_multi_exclude():
 
     # start sync testing
     cs = CauSync(config, src, dst, task='sync', excludes=['testfile2', 'testfile3'])
-    cs.config.DATE_FORMAT = date_format
+    cs.config = cs.config.replace(DATE_FORMAT=date_format)
     cs.run_sync()
 
     # collect destination testfile paths
@@ -54,7 +54,7 @@ def test_exclude_file():
 
     # start sync testing
     cs = CauSync(config, src, dst, task='sync')
-    cs.config.DATE_FORMAT = date_format
+    cs.config = cs.config.replace(DATE_FORMAT=date_format)
     cs.excludes = cs.parse_exclude_file('./temp/exclude.txt')
     cs.run_sync()
 
@@ -11,7 +11,7 @@ dst = path.realpath("/tmp/causync_dest")
 
 def test_find_latest_backups():
     cs = CauSync(config, src, dst, task='sync')
-    cs.config.DATE_FORMAT = "%Y%m%d"
+    cs.config = cs.config.replace(DATE_FORMAT="%Y%m%d")
 
     paths = ['20180411', '20180410', '20180409', '20180408', '20180407']
 
@@ -23,12 +23,12 @@ def test_find_latest_backups():
 
 def test_find_old_backups_daily():
     cs = CauSync(config, src, dst, task='cleanup')
-    cs.config.DATE_FORMAT = "%Y%m%d"
-    cs.config.BACKUPS_TO_KEEP = {'yearly': 10, 'monthly': 6,
-                                 'weekly': 4, 'daily': 7}
-    cs.config.BACKUP_MULTIPLIERS = {'yearly': 365, 'monthly': 31,
-                                    'weekly': 7, 'daily': 1}
-    cs.config.BACKUPS_LINK_DEST_COUNT = 5
+    cs.config = cs.config.replace(DATE_FORMAT="%Y%m%d",
+                                  BACKUPS_TO_KEEP={'yearly': 10, 'monthly': 6,
+                                                   'weekly': 4, 'daily': 7},
+                                  BACKUP_MULTIPLIERS={'yearly': 365, 'monthly': 31,
+                                                      'weekly': 7, 'daily': 1},
+                                  BACKUPS_LINK_DEST_COUNT=5)
     cs.curdate = datetime(year=2018, month=4, day=11)
 
     (dirnames_keep, dirnames_delete) = ([datetime(2018, 4, 11, 0, 0), datetime(2018, 4, 10, 0, 0),
@@ -55,12 +55,12 @@ def test_find_old_backups_daily():
 
 def test_find_old_backups_weekly():
     cs = CauSync(config, src, dst, task='cleanup')
-    cs.config.DATE_FORMAT = "%Y%m%d"
-    cs.config.BACKUPS_TO_KEEP = {'yearly': 10, 'monthly': 6,
-                                 'weekly': 4, 'daily': 7}
-    cs.config.BACKUP_MULTIPLIERS = {'yearly': 365, 'monthly': 31,
-                                    'weekly': 7, 'daily': 1}
-    cs.config.BACKUPS_LINK_DEST_COUNT = 5
+    cs.config = cs.config.replace(DATE_FORMAT="%Y%m%d",
+                                  BACKUPS_TO_KEEP={'yearly': 10, 'monthly': 6,
+                                                   'weekly': 4, 'daily': 7},
+                                  BACKUP_MULTIPLIERS={'yearly': 365, 'monthly': 31,
+                                                      'weekly': 7, 'daily': 1},
+                                  BACKUPS_LINK_DEST_COUNT=5)
     cs.curdate = datetime(year=2018, month=4, day=11)
 
     (dirnames_keep, dirnames_delete) = ([datetime(2018, 4, 9, 0, 0), datetime(2018, 4, 2, 0, 0)],
@@ -72,12 +72,12 @@ def test_find_old_backups_weekly():
 
 def test_find_old_backups_monthly():
     cs = CauSync(config, src, dst, task='cleanup')
-    cs.config.DATE_FORMAT = "%Y%m%d"
-    cs.config.BACKUPS_TO_KEEP = {'yearly': 10, 'monthly': 6,
-                                 'weekly': 4, 'daily': 7}
-    cs.config.BACKUP_MULTIPLIERS = {'yearly': 365, 'monthly': 31,
-                                    'weekly': 7, 'daily': 1}
-    cs.config.BACKUPS_LINK_DEST_COUNT = 5
+    cs.config = cs.config.replace(DATE_FORMAT="%Y%m%d",
+                                  BACKUPS_TO_KEEP={'yearly': 10, 'monthly': 6,
+                                                   'weekly': 4, 'daily': 7},
+                                  BACKUP_MULTIPLIERS={'yearly': 365, 'monthly': 31,
+                                                      'weekly': 7, 'daily': 1},
+                                  BACKUPS_LINK_DEST_COUNT=5)
     cs.curdate = datetime(year=2018, month=4, day=11)
 
     (dirnames_keep, dirnames_delete) = ([datetime(2018, 4, 1, 0, 0), datetime(2018, 3, 1, 0, 0),
@@ -99,12 +99,12 @@ def test_find_old_backups_monthly():
 
 def test_find_old_backups_yearly():
     cs = CauSync(config, src, dst, task='cleanup')
-    cs.config.DATE_FORMAT = "%Y%m%d"
-    cs.config.BACKUPS_TO_KEEP = {'yearly': 10, 'monthly': 6,
-                                 'weekly': 4, 'daily': 7}
-    cs.config.BACKUP_MULTIPLIERS = {'yearly': 365, 'monthly': 31,
-                                    'weekly': 7, 'daily': 1}
-    cs.config.BACKUPS_LINK_DEST_COUNT = 5
+    cs.config = cs.config.replace(DATE_FORMAT="%Y%m%d",
+                                  BACKUPS_TO_KEEP={'yearly': 10, 'monthly': 6,
+                                                   'weekly': 4, 'daily': 7},
+                                  BACKUP_MULTIPLIERS={'yearly': 365, 'monthly': 31,
+                                                      'weekly': 7, 'daily': 1},
+                                  BACKUPS_LINK_DEST_COUNT=5)
     cs.curdate = datetime(year=2018, month=4, day=11)
 
     (dirnames_keep, dirnames_delete) = ([datetime(2018, 1, 1, 0, 0), datetime(2017, 1, 1, 0, 0),
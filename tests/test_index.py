@@ -0,0 +1,82 @@
+from nose.tools import *
+
+from causync import CauSync, BackupIndex, parse_dirname, compile_date_format
+import config
+
+from tests.testhelper import *
+
+
+def test_parse_dirname():
+    assert_equals(parse_dirname('20180411', '%Y%m%d'), datetime(2018, 4, 11))
+    assert_equals(parse_dirname('20180411_111237', '%Y%m%d_%H%M%S'), datetime(2018, 4, 11, 11, 12, 37))
+    # strptime fallback for formats the fast parser doesn't know
+    assert_equals(compile_date_format('%y-%b-%d'), None)
+    assert_equals(parse_dirname('18-Apr-11', '%y-%b-%d'), datetime(2018, 4, 11))
+
+    for name in ['20181341', '2018041a', 'notes.txt', '20180411.tmp', '']:
+        assert_equals(parse_dirname(name, '%Y%m%d'), None)
+
+
+def test_backup_index():
+    names = list(dirnames) + ['.causync_hashes.json', 'lost+found']
+    index = BackupIndex(reversed(names), '%Y%m%d')
+
+    assert_equals(len(index), len(dirnames))
+    assert_equals(index.skipped, 2)
+    assert_equals(index.names, sorted(dirnames))
+
+    assert_equals(index.latest(3), ['20180411', '20180410', '20180409'])
+    assert_equals(index.latest(0), [])
+    assert_equals(index.latest(len(dirnames) + 5), sorted(dirnames, reverse=True))
+    assert_equals(index.older_than(datetime(2005, 1, 1)), ['20040101', '20050101'])
+    assert_equals(index.in_period(datetime(2018, 3, 1), datetime(2018, 4, 2)), ['20180401', '20180402'])
+
+
+def test_datetime_entries():
+    cs = CauSync(config, src, dst, task='cleanup')
+    cs.config = cs.config.replace(DATE_FORMAT="%Y%m%d", BACKUP_MULTIPLIERS={'daily': 1})
+    cs.curdate = datetime(2018, 4, 11)
+
+    # the finders take datetime entries like directory names
+    dates = [datetime(2018, 4, 9), datetime(2018, 4, 11), datetime(2018, 4, 10)]
+    assert_equals(cs.find_latest_backups(dates, 2),
+                  [os.path.join(cs.dst_abs, '20180411'), os.path.join(cs.dst_abs, '20180410')])
+    assert_equals(cs.find_old_backups(dates, 'daily', 1),
+                  cs.find_old_backups([d.strftime('%Y%m%d') for d in dates], 'daily', 1))
+
+
+def test_get_index_cache():
+    cs = CauSync(config, src, dst, task='cleanup')
+    cs.config = cs.config.replace(DATE_FORMAT="%Y%m%d")
+
+    index = cs.get_index(dirnames)
+    assert_true(cs.get_index(list(dirnames)) is index)
+    assert_true(cs.get_index(index) is index)
+    assert_false(cs.get_index(dirnames[1:]) is index)
+
+
+def test_list_backups():
+    create_temp()
+
+    os.makedirs(dst)
+    [os.makedirs(os.path.join(dst, i)) for i in dirnames[-3:]]
+    os.makedirs(os.path.join(dst, 'lost+found'))
+    open(os.path.join(dst, '.causync_history.jsonl'), 'w').close()
+    os.symlink(dirnames[-1], os.path.join(dst, 'latest'))
+
+    cs = CauSync(config, src, dst, task='check')
+    cs.config = cs.config.replace(DATE_FORMAT="%Y%m%d")
+
+    # old enough to be cached
+    os.utime(dst, (0, 0))
+    listing = cs.list_backups()
+    assert_equals(listing, tuple(sorted(dirnames[-3:] + ['lost+found'])))
+    assert_true(cs.list_backups() is listing)
+    # the file and the symlink, and a directory which isn't a backup
+    assert_equals(cs.count_skipped(), 3)
+
+    # a new backup changes the mtime of the destination
+    os.makedirs(os.path.join(dst, '20180412'))
+    assert_true('20180412' in cs.list_backups())
+
+    remove_temp()
@@ -11,7 +11,7 @@ def test_logfile_default():
 
     # start sync testing
     cs = CauSync(config, src, dst, task='sync')
-    cs.config.DATE_FORMAT = date_format
+    cs.config = cs.config.replace(DATE_FORMAT=date_format)
     cs.run_sync()
 
     # lockfile should not exist after sync
@@ -24,7 +24,7 @@ def test_logfile_custom():
 
     # start sync testing
     cs = CauSync(config, src, dst, task='sync', logfile='./temp/test.log')
-    cs.config.DATE_FORMAT = date_format
+    cs.config = cs.config.replace(DATE_FORMAT=date_format)
     cs.run_sync()
 
     # lockfile should not exist after sync
@@ -0,0 +1,143 @@
+from nose.tools import *
+import zipfile
+
+from causync import CauSync, CauSyncError
+import config
+
+from tests.testhelper import *
+
+
+def data_members(name):
+    with zipfile.ZipFile(os.path.join(dst, name + '.pack')) as zf:
+        return [i for i in zf.namelist() if i.startswith('data/')]
+
+
+def test_pack():
+    create_temp()
+
+    names = ['20160101', '20170101', '20170201', '20180410', '20180411']
+    snapshots = [os.path.join(dst, d, 'causync_src') for d in names]
+    shutil.copytree(src, snapshots[0])
+    for (i, snapshot) in enumerate(snapshots[1:]):
+        shutil.copytree(snapshots[i], snapshot, copy_function=os.link)
+        if names[i + 1] == '20170101':
+            # a new inode from 20170101 on
+            os.remove(os.path.join(snapshot, 'testdir1', 'testfile1'))
+            with open(os.path.join(snapshot, 'testdir1', 'testfile1'), 'w') as f:
+                f.write("changed")
+
+    cs = CauSync(config, src, dst, task='pack')
+    cs.config = cs.config.replace(DATE_FORMAT=date_format,
+                                  BACKUPS_LINK_DEST_COUNT=2,
+                                  PACK_AFTER_DAYS=365)
+    cs.curdate = datetime(2018, 4, 11)
+
+    assert_equals(cs.run_pack(), ['20160101', '20170101', '20170201'])
+
+    # listing and retention see packed backups as backups, but they're never --link-dest bases
+    assert_equals(cs.list_backups(), tuple(names))
+    assert_equals(cs.listing_packed[cs.dst_abs], frozenset(names[:3]))
+    assert_equals(cs.find_latest_backups(cs.list_backups(), 5),
+                  [os.path.join(cs.dst_abs, i) for i in ['20180411', '20180410']])
+    assert_false(os.path.exists(os.path.join(dst, '20160101')))
+
+    # contents are only stored once
+    assert_equals(len(data_members('20160101')), 3)
+    assert_equals(len(data_members('20170101')), 1)
+    assert_equals(len(data_members('20170201')), 0)
+
+    restored = os.path.join('./temp', 'restored')
+    cs.run_restore('20170201', 'causync_src/testdir1/testfile1', restored)
+    with open(restored) as f:
+        assert_equals(f.read(), "changed")
+    assert_equals(os.stat(restored).st_mtime_ns,
+                  os.stat(os.path.join(snapshots[-1], 'testdir1', 'testfile1')).st_mtime_ns)
+
+    # the shared contents of the deleted backup are moved to the next packed backup
+    cs.rmtree(['20160101'])
+    assert_false(os.path.exists(os.path.join(dst, '20160101.pack')))
+    assert_equals(len(data_members('20170101')), 3)
+    cs.run_restore('20170201', '/causync_src/testdir2/testfile3', restored)
+    with open(restored) as f:
+        assert_equals(f.read(), lorem[lorem_parts[2][0]:lorem_parts[2][1]])
+
+    assert_raises(CauSyncError, cs.run_restore, '20170201', 'causync_src/testdir1', restored)
+    assert_raises(CauSyncError, cs.run_restore, '20170201', 'causync_src/missing', restored)
+
+    remove_temp()
+
+
+def test_pack_old_mtime():
+    create_temp()
+
+    snapshot = os.path.join(dst, '20160101', 'causync_src')
+    shutil.copytree(src, snapshot)
+    os.makedirs(os.path.join(dst, '20180411'))
+    # zip can't store timestamps before 1980
+    testfile = os.path.join(snapshot, 'testdir1', 'testfile1')
+    os.utime(testfile, (0, 0))
+
+    cs = CauSync(config, src, dst, task='pack')
+    cs.config = cs.config.replace(DATE_FORMAT=date_format, BACKUPS_LINK_DEST_COUNT=1, PACK_AFTER_DAYS=365)
+    cs.curdate = datetime(2018, 4, 11)
+
+    assert_equals(cs.run_pack(), ['20160101'])
+    assert_false(os.path.exists(os.path.join(dst, '20160101.pack.tmp')))
+
+    restored = os.path.join('./temp', 'restored')
+    cs.run_restore('20160101', 'causync_src/testdir1/testfile1', restored)
+    assert_equals(os.stat(restored).st_mtime_ns, 0)
+
+    remove_temp()
+
+
+def test_pack_failure():
+    create_temp()
+
+    snapshot = os.path.join(dst, '20160101', 'causync_src')
+    shutil.copytree(src, snapshot)
+    os.makedirs(os.path.join(dst, '20180411'))
+
+    cs = CauSync(config, src, dst, task='pack')
+    # hashing fails with an invalid read size
+    cs.config = cs.config.replace(DATE_FORMAT=date_format, BACKUPS_LINK_DEST_COUNT=1, PACK_AFTER_DAYS=365,
+                                  VERIFY_CHUNK_SIZE='invalid')
+    cs.curdate = datetime(2018, 4, 11)
+
+    assert_raises(TypeError, cs.run_pack)
+    assert_false(os.path.exists(os.path.join(dst, '20160101.pack.tmp')))
+    assert_false(os.path.exists(os.path.join(dst, '20160101.pack')))
+    assert_true(os.path.isdir(snapshot))
+
+    remove_temp()
+
+
+def test_cleanup_all_packed():
+    create_temp()
+
+    site = './temp/backups/site'
+    names = ['20030101', '20040101', '20050101', '20060101', '20070101', '20170101']
+    shutil.copytree(src, os.path.join(site, names[0], 'causync_src'))
+    for (i, name) in enumerate(names[1:]):
+        # shared contents, removing a pack rewrites the newer packs
+        shutil.copytree(os.path.join(site, names[i]), os.path.join(site, name), copy_function=os.link)
+
+    cs = CauSync(config, src, site, task='pack')
+    cs.config = cs.config.replace(DATE_FORMAT=date_format, BACKUPS_LINK_DEST_COUNT=0, PACK_AFTER_DAYS=0)
+    cs.curdate = datetime(2018, 4, 11)
+    assert_equals(cs.run_pack(), names)
+
+    # only packed backups left, it's still a destination
+    cs = CauSync(config, [], './temp/backups', task='cleanup-all')
+    cs.config = cs.config.replace(DATE_FORMAT=date_format)
+    cs.curdate = datetime(2018, 4, 11)
+    assert_equals(cs.find_destinations(cs.dst_abs), [os.path.realpath(site)])
+
+    plan = cs.plan_cleanup_all()[0]
+    deleted = [i['name'] for i in plan['delete']]
+    assert_true(len(deleted) > 1)
+    assert_equals(cs.run_cleanup_all()[0]['deleted'], len(deleted))
+    assert_equals(sorted(os.listdir(site)), sorted(i['name'] + '.pack' for i in plan['keep']))
+    assert_true(os.path.isfile(os.path.join(site, '20170101.pack')))
+
+    remove_temp()
@@ -0,0 +1,99 @@
+import json
+import subprocess
+
+from nose.tools import *
+
+from causync import CauSync, check_status
+import config
+
+from tests.testhelper import *
+
+
+def test_scan_sources():
+    create_temp()
+
+    cs = CauSync(config, src, dst, task='sync')
+    # the source itself, two directories and three files
+    assert_equals(cs.scan_sources(), (6, len(lorem[0:123]) + len(lorem[124:232]) + len(lorem[233:335])))
+
+    cs = CauSync(config, src, dst, task='sync', excludes=['testfile2', '/causync_src/testdir2'])
+    assert_equals(cs.scan_sources(), (3, len(lorem[0:123])))
+
+    remove_temp()
+
+
+def test_is_excluded():
+    assert_true(CauSync.is_excluded('src/a/b.log', 'b.log', ['*.log']))
+    assert_true(CauSync.is_excluded('src/a', 'a', ['/src/a/']))
+    assert_false(CauSync.is_excluded('src/b/src/a', 'a', ['/src/a']))
+    assert_true(CauSync.is_excluded('src/b/src/a', 'a', ['src/a']))
+    assert_false(CauSync.is_excluded('src/a', 'a', ['b', 'src/b']))
+
+
+def test_estimate_cache():
+    create_temp()
+    os.makedirs(dst)
+
+    cs = CauSync(config, src, dst, task='sync')
+    estimate = cs.estimate_sources()
+    assert_equals(estimate['source'], 'scan')
+    assert_equals(estimate['files'], 6)
+
+    # refreshed by the stats of a sync
+    cs.save_scan_cache(10, 2000)
+    estimate = cs.estimate_sources()
+    assert_equals((estimate['source'], estimate['files'], estimate['bytes']), ('cache', 10, 2000))
+
+    cs.config = cs.config.replace(SCAN_CACHE_DAYS=0)
+    assert_equals(cs.estimate_sources()['source'], 'scan')
+
+    # other excludes have their own estimate
+    cs = CauSync(config, src, dst, task='sync', excludes=['testdir2'])
+    assert_equals(cs.estimate_sources()['source'], 'scan')
+
+    remove_temp()
+
+
+def test_check_estimate_readonly():
+    create_temp()
+    os.makedirs(dst)
+
+    # check --estimate scans the sources but leaves the scan cache to sync
+    cs = CauSync(config, src, dst, task='check', estimate=True)
+    estimate = cs.estimate_sync()
+    assert_equals((estimate['source'], estimate['files']), ('scan', 6))
+    assert_false(os.path.exists(os.path.join(dst, config.SCAN_CACHE_FILE)))
+
+    cs.save_scan_cache(10, 2000)
+    assert_equals(cs.estimate_sync()['source'], 'cache')
+
+    remove_temp()
+
+
+def test_rsync_progress():
+    create_temp()
+
+    pidfile = './temp/causync.pid'
+    cs = CauSync(config, src, dst, task='sync', pidfile=pidfile, progress=True)
+    cs.estimate = {'files': 4, 'bytes': 10000}
+    cs.sync_started = datetime.now()
+    cs.create_pidfile()
+
+    # what rsync --info=progress2 --stats prints
+    cmd = "printf '      1.00K  10%%    1.00MB/s    0:00:01\\r      2.50K  25%%    1.00MB/s    0:00:01 " \
+          "(xfr#1, to-chk=1/4)\\r\\nNumber of files: 4\\n'"
+    output = cs.run_rsync(cmd)
+
+    assert_equals(CauSync.parse_rsync_stats(output), {'Number of files': 4})
+    status = json.loads(check_status(pidfile))
+    assert_equals(status['bytes_done'], 2500)
+    assert_equals(status['files_done'], 3)
+    # three of four files were checked, that's further than the bytes
+    assert_equals(status['progress'], 0.75)
+    assert_equals(status['estimated_bytes'], 10000)
+    assert_true(status['eta'] is not None)
+
+    assert_raises(subprocess.CalledProcessError, cs.run_rsync, "exit 3")
+
+    cs.remove_pidfile()
+    remove_temp()
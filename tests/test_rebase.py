@@ -0,0 +1,67 @@
+from nose.tools import *
+
+from causync import CauSync
+import config
+
+from tests.testhelper import *
+
+
+def test_rebase():
+    create_temp()
+
+    snapshots = [os.path.join(dst, d, 'causync_src') for d in ['20180409', '20180410', '20180411']]
+    shutil.copytree(src, snapshots[0])
+    for snapshot in snapshots[1:]:
+        shutil.copytree(snapshots[0], snapshot, copy_function=os.link)
+
+    cs = CauSync(config, src, dst, task='rebase')
+    cs.config = cs.config.replace(DATE_FORMAT=date_format,
+                                  LINK_MAX=3,
+                                  LINK_REBASE_RATIO=1.0)
+
+    testfile = os.path.join('testdir1', 'testfile1')
+    assert_equals(os.lstat(os.path.join(snapshots[2], testfile)).st_nlink, 3)
+
+    cs.dry_run = True
+    assert_equals(cs.run_rebase(), 3)
+    assert_equals(os.lstat(os.path.join(snapshots[2], testfile)).st_nlink, 3)
+
+    cs.dry_run = False
+    assert_equals(cs.run_rebase(), 3)
+
+    # the latest backup has fresh copies, the older ones still share the old inode
+    assert_equals(os.lstat(os.path.join(snapshots[2], testfile)).st_nlink, 1)
+    assert_equals(os.lstat(os.path.join(snapshots[1], testfile)).st_nlink, 2)
+    with open(os.path.join(snapshots[2], testfile), 'r') as fp:
+        assert_equals(fp.read(), lorem[lorem_parts[0][0]: lorem_parts[0][1]])
+
+    assert_equals(cs.run_rebase(), 0)
+
+    remove_temp()
+
+
+def test_rebase_links_in_backup():
+    create_temp()
+
+    snapshots = [os.path.join(dst, d, 'causync_src') for d in ['20180410', '20180411']]
+    shutil.copytree(src, snapshots[0])
+    shutil.copytree(snapshots[0], snapshots[1], copy_function=os.link)
+    # a second link of testfile1 inside the latest backup
+    (testfile, other) = (os.path.join('testdir1', 'testfile1'), os.path.join('testdir2', 'testfile1_link'))
+    os.link(os.path.join(snapshots[1], testfile), os.path.join(snapshots[1], other))
+
+    cs = CauSync(config, src, dst, task='rebase')
+    cs.config = cs.config.replace(DATE_FORMAT=date_format,
+                                  LINK_MAX=3,
+                                  LINK_REBASE_RATIO=1.0)
+
+    assert_equals(cs.run_rebase(), 1)
+
+    # both links point to the same fresh copy
+    (a, b) = (os.lstat(os.path.join(snapshots[1], testfile)), os.lstat(os.path.join(snapshots[1], other)))
+    assert_equals(a.st_ino, b.st_ino)
+    assert_equals(a.st_nlink, 2)
+    assert_equals(os.lstat(os.path.join(snapshots[0], testfile)).st_nlink, 1)
+    assert_false(os.path.exists(os.path.join(snapshots[1], other + '.causync-rebase')))
+
+    remove_temp()
@@ -0,0 +1,139 @@
+import json
+import subprocess
+import sys
+import threading
+from stat import S_IMODE
+
+from nose.tools import *
+
+from causync import CauSync, CauSyncError
+import config
+
+from tests.testhelper import *
+
+replica = './temp/causync_replica'
+
+
+def create_backups():
+    create_temp()
+
+    base = os.path.join(dst, '20180410', 'causync_src')
+    snapshot = os.path.join(dst, '20180411', 'causync_src')
+    shutil.copytree(src, base)
+    shutil.copytree(base, snapshot, copy_function=os.link)
+
+    # a changed file, a new file with two links and a symlink
+    os.remove(os.path.join(snapshot, 'testdir1', 'testfile1'))
+    with open(os.path.join(snapshot, 'testdir1', 'testfile1'), 'w') as f:
+        f.write("changed")
+    with open(os.path.join(snapshot, 'testdir2', 'new'), 'w') as f:
+        f.write("new")
+    os.link(os.path.join(snapshot, 'testdir2', 'new'), os.path.join(snapshot, 'new_link'))
+    os.symlink('testdir2/new', os.path.join(snapshot, 'symlink'))
+
+
+def send_receive(snapshot, base=None):
+    """ Sends a backup from dst to replica over a pipe. """
+
+    (r, w) = os.pipe()
+    sender = CauSync(config, src, dst, task='send')
+    receiver = CauSync(config, src, replica, task='receive')
+
+    def send():
+        with os.fdopen(w, 'wb') as out:
+            sender.run_send(snapshot, base, out)
+
+    thread = threading.Thread(target=send)
+    thread.start()
+    with os.fdopen(r, 'rb') as inp:
+        counts = receiver.run_receive(inp)
+    thread.join()
+
+    return counts
+
+
+def test_send_receive():
+    create_backups()
+
+    counts = send_receive('20180410')
+    assert_equals((counts['files'], counts['linked']), (3, 0))
+
+    counts = send_receive('20180411', '20180410')
+    # only the changed and the new file have data in the stream
+    assert_equals((counts['files'], counts['linked'], counts['bytes']), (2, 2, len("changed") + len("new")))
+
+    (base, snapshot) = [os.path.join(replica, d, 'causync_src') for d in ['20180410', '20180411']]
+    assert_false(os.path.exists(os.path.join(replica, '20180411.partial')))
+    assert_true(os.path.samefile(os.path.join(base, 'testdir1', 'testfile2'),
+                                 os.path.join(snapshot, 'testdir1', 'testfile2')))
+    assert_false(os.path.samefile(os.path.join(base, 'testdir1', 'testfile1'),
+                                  os.path.join(snapshot, 'testdir1', 'testfile1')))
+    with open(os.path.join(snapshot, 'testdir1', 'testfile1')) as f:
+        assert_equals(f.read(), "changed")
+    assert_true(os.path.samefile(os.path.join(snapshot, 'testdir2', 'new'), os.path.join(snapshot, 'new_link')))
+    assert_equals(os.readlink(os.path.join(snapshot, 'symlink')), 'testdir2/new')
+
+    original = os.path.join(dst, '20180411', 'causync_src', 'testdir2')
+    assert_equals(os.stat(os.path.join(snapshot, 'testdir2')).st_mtime_ns, os.stat(original).st_mtime_ns)
+    assert_equals(os.stat(os.path.join(snapshot, 'testdir2', 'testfile3')).st_mtime_ns,
+                  os.stat(os.path.join(original, 'testfile3')).st_mtime_ns)
+
+    # the backup exists already
+    assert_raises(CauSyncError, send_receive, '20180411', '20180410')
+
+    remove_temp()
+
+
+def test_send_receive_cli():
+    create_backups()
+
+    args = "-q --logfile ./temp/causync.log"
+    subprocess.check_call("{py} causync.py send {dst} --snapshot 20180410 {args} | "
+                          "{py} causync.py receive {replica} -p ./temp/causync.pid {args}".format(
+                              py=sys.executable, dst=dst, replica=replica, args=args), shell=True)
+
+    with open(os.path.join(replica, '20180410', 'causync_src', 'testdir2', 'testfile3')) as f:
+        assert_equals(f.read(), lorem[lorem_parts[2][0]:lorem_parts[2][1]])
+
+    remove_temp()
+
+
+def test_receive_invalid():
+    create_temp()
+
+    (r, w) = os.pipe()
+    with os.fdopen(w, 'wb') as out:
+        out.write(b'CAUSYNC-STREAM 1\n{"snapshot": "20180411", "base": null}\n["file", "../escape", 420, 0, 0, 0, 0]\n')
+
+    receiver = CauSync(config, src, replica, task='receive')
+    with os.fdopen(r, 'rb') as inp:
+        assert_raises(CauSyncError, receiver.run_receive, inp)
+    assert_false(os.path.exists(os.path.join('./temp', 'escape')))
+    assert_false(os.path.exists(os.path.join(replica, '20180411.partial')))
+
+    remove_temp()
+
+
+def test_receive_symlink_escape():
+    create_temp()
+    outside = os.path.abspath(os.path.join('./temp', 'outside'))
+    os.makedirs(outside)
+
+    # a symlink to a directory outside of the backup, then files written through it
+    for records in ([["symlink", "a", outside, 0, 0, 0], ["file", "a/pwned", 420, 0, 0, 0, 0]],
+                    [["symlink", "b", os.path.join(outside, "file"), 0, 0, 0], ["file", "b", 420, 0, 0, 0, 0]],
+                    [["symlink", "c", outside, 0, 0, 0], ["attr", "c", 511, 0, 0, 0]]):
+        (r, w) = os.pipe()
+        with os.fdopen(w, 'wb') as out:
+            out.write(b'CAUSYNC-STREAM 1\n{"snapshot": "20180411", "base": null}\n')
+            for record in records:
+                out.write(json.dumps(record).encode() + b'\n')
+
+        receiver = CauSync(config, src, replica, task='receive')
+        with os.fdopen(r, 'rb') as inp:
+            assert_raises(CauSyncError, receiver.run_receive, inp)
+        assert_equals(os.listdir(outside), [])
+        assert_not_equals(S_IMODE(os.stat(outside).st_mode), 511)
+        assert_false(os.path.exists(os.path.join(replica, '20180411.partial')))
+
+    remove_temp()
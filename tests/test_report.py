@@ -0,0 +1,38 @@
+from io import StringIO
+
+from nose.tools import *
+
+from causync import CauSync
+import config
+
+from tests.testhelper import *
+
+
+def test_report():
+    create_temp()
+    os.makedirs(dst)
+
+    cs = CauSync(config, [], dst, task='report')
+    cs.curdate = datetime(2018, 4, 30)
+
+    # 3 weeks of stable runs, then the file list generation time doubles
+    for day in range(1, 30):
+        slow = day >= 23
+        cs.save_history({'date': datetime(2018, 4, day, 1, 0).isoformat(), 'task': 'sync',
+                         'duration': 120.0, 'bytes_transferred': 1200000, 'files_scanned': 50000,
+                         'file_list_generation_time': 25.0 if slow else 10.0})
+    cs.save_history({'date': datetime(2018, 4, 29, 2, 0).isoformat(), 'task': 'cleanup',
+                     'cleanup_duration': 5.0})
+
+    history = cs.load_history()
+    assert_equals(len(history), 30)
+
+    out = StringIO()
+    regressions = cs.run_report(out)
+
+    assert_equals(len(regressions), 1)
+    assert_true(regressions[0].startswith("file list generation time (s) went from 10.00 to 25.00"))
+    assert_true("REGRESSION: file list generation time" in out.getvalue())
+    assert_true("cleanup duration (s)" in out.getvalue())
+
+    remove_temp()
@@ -0,0 +1,166 @@
+import json
+import shlex
+
+from nose.tools import *
+
+from causync import CauSync
+import config
+
+from tests.testhelper import *
+
+
+def test_get_shards():
+    create_temp()
+    os.mkdir(os.path.join(src, 'testdir3'))
+
+    cs = CauSync(config, src, dst, task='sync', shards=True)
+    assert_equals(cs.get_shards(src), [['testdir1'], ['testdir2'], ['testdir3']])
+
+    shard_file = './temp/shards.txt'
+    with open(shard_file, 'w') as fp:
+        fp.write("testdir1\ttestdir3\nmissing\n")
+
+    cs = CauSync(config, src, dst, task='sync', shard_file=shard_file)
+    assert_true(cs.shards)
+    assert_equals(cs.get_shards(cs.src_abs[0]), [['testdir1', 'testdir3'], ['testdir2']])
+
+    remove_temp()
+
+
+def test_sharded_sync():
+    create_temp()
+
+    cs = CauSync(config, src, dst, task='sync', shards=True)
+    cs.config = cs.config.replace(DATE_FORMAT=date_format)
+    output = cs.run_sync()
+
+    files = [os.path.join(dst, curdate_str, 'causync_src', 'testdir1', 'testfile1'),
+             os.path.join(dst, curdate_str, 'causync_src', 'testdir1', 'testfile2'),
+             os.path.join(dst, curdate_str, 'causync_src', 'testdir2', 'testfile3')]
+
+    for i in range(0, 3):
+        with open(files[i], 'r') as fp:
+            assert_equals(fp.read(), lorem[lorem_parts[i][0]: lorem_parts[i][1]])
+
+    # the checkpoint is removed after a complete sync
+    assert_false(os.path.isfile(os.path.join(dst, config.CHECKPOINT_FILE)))
+    # without progress the bytes done are summed from the stats of each shard
+    assert_equals(cs.bytes_done, CauSync.parse_rsync_stats(output)['Total transferred file size'])
+    assert_true(cs.bytes_done > 0)
+
+    remove_temp()
+
+
+def test_sharded_sync_resume():
+    create_temp()
+    os.makedirs(dst)
+
+    # a previous sync of today's backup failed after the first two shards
+    realsrc = os.path.realpath(src)
+    with open(os.path.join(dst, config.CHECKPOINT_FILE), 'w') as fp:
+        json.dump({'snapshot': curdate_str, 'completed': [realsrc, "{}\ttestdir1".format(realsrc)]}, fp)
+
+    cs = CauSync(config, src, dst, task='sync', shards=True)
+    cs.config = cs.config.replace(DATE_FORMAT=date_format)
+    cs.run_sync()
+
+    # only the incomplete shard is synced
+    assert_false(os.path.isdir(os.path.join(dst, curdate_str, 'causync_src', 'testdir1')))
+    assert_true(os.path.isfile(os.path.join(dst, curdate_str, 'causync_src', 'testdir2', 'testfile3')))
+
+    remove_temp()
+
+
+def test_sharded_sync_resume_keeps_old_backups():
+    create_temp()
+
+    # yesterday's backup, and today's failed sync which already linked testdir2 to it
+    previous = os.path.join(dst, '20000101', 'causync_src')
+    today = os.path.join(dst, curdate_str, 'causync_src')
+    shutil.copytree(src, previous)
+    shutil.copytree(previous, today, copy_function=os.link)
+    realsrc = os.path.realpath(src)
+    with open(os.path.join(dst, config.CHECKPOINT_FILE), 'w') as fp:
+        json.dump({'snapshot': curdate_str, 'completed': [realsrc, "{}\ttestdir1".format(realsrc)]}, fp)
+
+    # the source changed before the resume
+    with open(os.path.join(src, 'testdir2', 'testfile3'), 'w') as fp:
+        fp.write("changed")
+
+    cs = CauSync(config, src, dst, task='sync', shards=True)
+    cs.config = cs.config.replace(DATE_FORMAT=date_format)
+    assert_false('--inplace' in cs.get_rsync_flags(os.path.join(cs.dst_abs, curdate_str)).split())
+    assert_true('--inplace' in cs.get_rsync_flags(os.path.join(cs.dst_abs, '20991231')).split())
+    cs.run_sync()
+
+    with open(os.path.join(today, 'testdir2', 'testfile3')) as fp:
+        assert_equals(fp.read(), "changed")
+    with open(os.path.join(previous, 'testdir2', 'testfile3')) as fp:
+        assert_equals(fp.read(), lorem[lorem_parts[2][0]:lorem_parts[2][1]])
+
+    remove_temp()
+
+
+def test_sharded_sync_protect():
+    create_temp()
+    os.makedirs(dst)
+
+    cs = CauSync(config, src, dst, task='sync', shards=True)
+    cmds = list()
+    cs.run_rsync = lambda cmd: cmds.append(cmd) or ""
+    today = os.path.join(cs.dst_abs, curdate_str)
+
+    # a copy-on-write clone is synced with --delete-excluded, the first shard must keep the shards' directories
+    cs.run_sharded_sync(" --delete --delete-excluded ", [], today, protect=True)
+    args = shlex.split(cmds[0])
+    assert_equals(len(cmds), 3)
+    assert_true(args.index("--filter=P /causync_src/testdir1/") < args.index("--exclude=/causync_src/*/"))
+    assert_true(args.index("--filter=P /causync_src/testdir2/") < args.index("--exclude=/causync_src/*/"))
+    assert_false(any('--filter' in c for c in cmds[1:]))
+
+    cmds[:] = []
+    cs.run_sharded_sync("", [], today)
+    assert_false(any('--filter' in c for c in cmds))
+
+    remove_temp()
+
+
+def test_sharded_sync_excludes():
+    create_temp()
+    os.makedirs(dst)
+
+    excludes = ['/causync_src/testdir1/testfile1', '*.tmp', '/other_src/testdir2', '/causync_src/']
+    assert_equals(CauSync.get_shard_excludes(excludes, 'causync_src'), ['/testdir1/testfile1', '*.tmp'])
+
+    cs = CauSync(config, src, dst, task='sync', shards=True, excludes=excludes)
+    cs.config = cs.config.replace(DATE_FORMAT=date_format)
+    cmds = list()
+    cs.run_rsync = lambda cmd: cmds.append(cmd) or ""
+    cs.run_sync()
+
+    # anchored patterns are rewritten for the shards' transfer root
+    args = [[a[len('--exclude='):] for a in shlex.split(c) if a.startswith('--exclude=')] for c in cmds]
+    assert_equals(args[0], excludes + ['/causync_src/*/'])
+    assert_equals(args[1], ['/testdir1/testfile1', '*.tmp'])
+    assert_equals(args[2], ['/testdir1/testfile1', '*.tmp'])
+
+    remove_temp()
+
+
+def test_resumed_sync_link_dest():
+    create_temp()
+
+    # yesterday's backup, and today's partial backup of a failed sync
+    for name in ('20000101', curdate_str):
+        shutil.copytree(src, os.path.join(dst, name, 'causync_src'))
+
+    cs = CauSync(config, src, dst, task='sync')
+    cs.config = cs.config.replace(DATE_FORMAT=date_format, BACKUPS_LINK_DEST_COUNT=1)
+    cmds = list()
+    cs.run_rsync = lambda cmd: cmds.append(cmd) or ""
+    cs.run_sync()
+
+    link_dests = [a for a in shlex.split(cmds[0]) if a.startswith('--link-dest=')]
+    assert_equals(link_dests, ['--link-dest={}'.format(os.path.join(cs.dst_abs, '20000101'))])
+
+    remove_temp()
@@ -0,0 +1,74 @@
+import json
+import subprocess
+import sys
+
+from nose.tools import *
+
+from causync import CauSync, check_status, get_pidfile_arg, get_statusfile
+import config
+
+from tests.testhelper import *
+
+
+def test_check_status():
+    create_temp()
+
+    pidfile = './temp/causync.pid'
+    assert_equals(json.loads(check_status(pidfile)), {'running': False})
+
+    cs = CauSync(config, src, dst, task='sync', pidfile=pidfile)
+    cs.create_pidfile()
+    cs.set_status('sync', bytes_done=1234)
+
+    status = json.loads(check_status(pidfile))
+    assert_true(status['running'])
+    assert_equals(status['pid'], os.getpid())
+    assert_equals(status['phase'], 'sync')
+    assert_equals(status['bytes_done'], 1234)
+
+    cs.remove_pidfile()
+    assert_false(os.path.isfile(get_statusfile(pidfile)))
+    assert_equals(json.loads(check_status(pidfile)), {'running': False})
+
+    # pidfile of a process which doesn't exist anymore
+    with open(pidfile, 'w') as f:
+        f.write('999999999')
+    assert_equals(json.loads(check_status(pidfile)), {'running': False, 'stale_pid': 999999999})
+
+    remove_temp()
+
+
+def test_status_cli():
+    create_temp()
+
+    pidfile = './temp/causync.pid'
+    cs = CauSync(config, src, dst, task='sync', pidfile=pidfile)
+    cs.create_pidfile()
+    cs.set_status('sync', bytes_done=1234)
+
+    # the small status module and the fast path of causync.py print the same status
+    for cmd in (['causync_status.py', '-p', pidfile], ['causync.py', 'check', '--status', '-p', pidfile, src, dst]):
+        status = json.loads(subprocess.check_output([sys.executable] + cmd).decode())
+        assert_equals((status['pid'], status['bytes_done']), (os.getpid(), 1234))
+
+    cs.remove_pidfile()
+    remove_temp()
+
+
+def test_get_pidfile_arg():
+    assert_equals(get_pidfile_arg(['causync.py', 'check', '--status', 'a', 'b'], 'x.pid'), 'x.pid')
+    assert_equals(get_pidfile_arg(['causync.py', 'check', '-p', 'y.pid', 'a', 'b'], 'x.pid'), 'y.pid')
+    assert_equals(get_pidfile_arg(['causync.py', 'check', '--pidfile=z.pid', 'a', 'b'], 'x.pid'), 'z.pid')
+
+
+def test_parse_rsync_stats():
+    output = ("Number of files: 4 (reg: 3, dir: 1)\n"
+              "Total file size: 1,234 bytes\n"
+              "Total transferred file size: 1.50K bytes\n"
+              "File list generation time: 0.001 seconds\n")
+    stats = CauSync.parse_rsync_stats(output)
+
+    assert_equals(stats['Number of files'], 4)
+    assert_equals(stats['Total file size'], 1234)
+    assert_equals(stats['Total transferred file size'], 1500)
+    assert_equals(stats['File list generation time'], 0.001)
@@ -11,7 +11,7 @@ def test_lockfile_after_sync():
 
     # start sync testing
     cs = CauSync(config, src, dst, task='sync')
-    cs.config.DATE_FORMAT = date_format
+    cs.config = cs.config.replace(DATE_FORMAT=date_format)
     cs.run_sync()
 
     # lockfile should not exist after sync
@@ -25,7 +25,7 @@ def test_dry_run():
 
     # start sync testing
     cs = CauSync(config, src, dst, task='sync')
-    cs.config.DATE_FORMAT = date_format
+    cs.config = cs.config.replace(DATE_FORMAT=date_format)
     cs.dry_run = True
     cs.run_sync()
 
@@ -48,7 +48,7 @@ def test_sync():
 
     # start sync testing
     cs = CauSync(config, src, dst, task='sync')
-    cs.config.DATE_FORMAT = date_format
+    cs.config = cs.config.replace(DATE_FORMAT=date_format)
     cs.run_sync()
 
     # check for test dirs
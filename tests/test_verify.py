@@ -0,0 +1,67 @@
+from nose.tools import *
+
+from causync import CauSync, CauSyncError
+import config
+
+from tests.testhelper import *
+
+
+def make_snapshots():
+    """ Creates a previous backup (copy of the source) and a current one
+        (hard links to the previous backup, except for testfile3).
+    """
+    (previous, current) = ('20180410', '20180411')
+    shutil.copytree(src, os.path.join(dst, previous, 'causync_src'))
+    for d in ['testdir1', 'testdir2']:
+        os.makedirs(os.path.join(dst, current, 'causync_src', d))
+    for f in [os.path.join('testdir1', 'testfile1'), os.path.join('testdir1', 'testfile2')]:
+        os.link(os.path.join(dst, previous, 'causync_src', f), os.path.join(dst, current, 'causync_src', f))
+    shutil.copy2(os.path.join(src, 'testdir2', 'testfile3'),
+                 os.path.join(dst, current, 'causync_src', 'testdir2', 'testfile3'))
+    return previous, current
+
+
+def test_verify():
+    create_temp()
+    (previous, current) = make_snapshots()
+
+    cs = CauSync(config, src, dst, task='verify')
+    cs.config = cs.config.replace(DATE_FORMAT=date_format)
+
+    result = cs.run_verify()
+    assert_equals(result['verified'], 1)
+    assert_equals(result['linked'], 2)
+    assert_equals(result['cached'], 0)
+    assert_equals(result['mismatched'], [])
+    assert_equals(result['missing'], [])
+
+    # the new inode is already verified now
+    result = cs.run_verify()
+    assert_equals(result['verified'], 0)
+    assert_equals(result['cached'], 1)
+
+    # the previous backup has no older backup, everything in it is new
+    result = cs.run_verify(previous)
+    assert_equals(result['verified'], 3)
+
+    remove_temp()
+
+
+def test_verify_mismatch():
+    create_temp()
+    (previous, current) = make_snapshots()
+
+    with open(os.path.join(src, 'testdir2', 'testfile3'), 'w') as fp:
+        fp.write(lorem)
+
+    cs = CauSync(config, src, dst, task='verify', quiet=True, logfile='./temp/verify.log')
+    cs.config = cs.config.replace(DATE_FORMAT=date_format)
+
+    with assert_raises(CauSyncError) as e:
+        cs.run_verify()
+    assert_equals(str(e.exception), "verify failed: 1 mismatched, 0 missing")
+    with open('./temp/verify.log') as fp:
+        assert_in("checksum mismatch: {}".format(
+            os.path.realpath(os.path.join(dst, current, 'causync_src', 'testdir2', 'testfile3'))), fp.read())
+
+    remove_temp()